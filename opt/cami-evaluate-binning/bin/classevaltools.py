@@ -1,37 +1,189 @@
 # this file contains common functions and data for working with confusion
 # matrices and their evaluation
 
-from itertools import count
+from heapq import merge
+from itertools import chain, count, izip, product
 from math import isnan, ceil, log
+from mmap import mmap, ACCESS_READ
+from os import fstat, rename, getpid, fdopen, remove
+from stat import S_ISREG
+from struct import pack, unpack_from
 from sys import stderr
+from tempfile import TemporaryFile, mkstemp
 
-from numpy import array, empty, arange, mean, std, zeros
+from numpy import array, empty, arange, mean, std, zeros, unique, bincount, concatenate, int64, frombuffer, \
+	asarray, cumsum, diff, repeat, searchsorted, lexsort, \
+	log as array_log, fromstring, fromfile
 
 
 float_nan = float('NaN')
+no_entry = object()  # marks an identifier which is missing on one side of a join
+binary_magic = "\x93CMAT\x01\n"  # first line of the binary confusion matrix format
+index_suffix = ".idx"  # file name extension of saved confusion matrix offset indices
+text_block_cells = 2**20  # cells of the text form converted at once
+
+# fields of ConfusionMatrix.all_metrics(), measures are fractions
+summary_metrics_dtype = [
+	("precision", float), ("precision_std", float), ("precision_classes", int),
+	("recall", float), ("recall_std", float), ("recall_classes", int),
+	("accuracy", float), ("misclassification_rate", float),
+	("entropy", float), ("rand", float), ("adjusted_rand", float)]
+class_metrics_dtype = [
+	("name", object), ("predicted_size", float), ("real_size", float), ("correct", float),
+	("precision", float), ("recall", float)]
+
+
+def _running_sum(values):
+	"""sum in index order like an accumulating loop, numpy's sum() adds pairwise and rounds differently"""
+	if len(values):
+		return cumsum(values)[-1]
+	return 0.
+
+
+class SparseMatrix:
+	"""
+	Matrix in compressed sparse row (CSR) form whose memory scales with the number of non-zero
+	cells. It implements the part of the numpy array interface used by ConfusionMatrix: shape,
+	m[i] (dense row), m[i, j], m[:, j] (dense column), iteration over dense rows and sum(axis).
+	"""
+
+	def __init__(self, indptr, indices, data, shape):
+		self.indptr = indptr
+		self.indices = indices
+		self.data = data
+		self.shape = shape
+		self._csc = None
+
+	@classmethod
+	def from_triplets(cls, rows, cols, values, shape):
+		"""build from row indices, column indices and values, duplicate cells are summed up"""
+		rows = asarray(rows, dtype=int64)
+		cols = asarray(cols, dtype=int64)
+		keys, inverse = unique(rows * shape[1] + cols, return_inverse=True)
+		data = bincount(inverse, weights=asarray(values, dtype=float))
+		keep = data != 0
+		keys, data = keys[keep], data[keep]
+		indptr = concatenate(([0], cumsum(bincount(keys // max(shape[1], 1), minlength=shape[0]))))
+		return cls(indptr, keys % max(shape[1], 1), data, shape)
+
+	@classmethod
+	def from_dense(cls, mat):
+		mat = asarray(mat, dtype=float)
+		rows, cols = mat.nonzero()  # in row-major order, i.e. already sorted
+		indptr = concatenate(([0], cumsum(bincount(rows, minlength=mat.shape[0]))))
+		return cls(indptr, cols, mat[rows, cols], mat.shape)
+
+	def _rowindices(self):
+		return repeat(arange(self.shape[0]), diff(self.indptr))
+
+	def _value(self, i, j):
+		lo, hi = self.indptr[i], self.indptr[i + 1]
+		k = lo + searchsorted(self.indices[lo:hi], j)
+		if k < hi and self.indices[k] == j:
+			return self.data[k]
+		return 0.
+
+	def row(self, i):
+		lo, hi = self.indptr[i], self.indptr[i + 1]
+		row = zeros(self.shape[1])
+		row[self.indices[lo:hi]] = self.data[lo:hi]
+		return row
+
+	def col(self, j):
+		if self._csc is None:  # column-ordered view of the cells, built on first use
+			order = self.indices.argsort(kind="mergesort")
+			colptr = concatenate(([0], cumsum(bincount(self.indices, minlength=self.shape[1]))))
+			self._csc = colptr, self._rowindices()[order], self.data[order]
+		colptr, rows, data = self._csc
+		col = zeros(self.shape[0])
+		col[rows[colptr[j]:colptr[j + 1]]] = data[colptr[j]:colptr[j + 1]]
+		return col
+
+	def __getitem__(self, key):
+		if isinstance(key, tuple):
+			i, j = key
+			if isinstance(i, slice):
+				assert i == slice(None), "only full column slices are supported"
+				return self.col(j)
+			if i < 0 or i >= self.shape[0] or j < 0 or j >= self.shape[1]:
+				raise IndexError("index (%i, %i) is out of bounds" % (i, j))
+			return self._value(i, j)
+		return self.row(key)
+
+	def __iter__(self):
+		for i in xrange(self.shape[0]):
+			yield self.row(i)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def sum(self, axis=None):
+		if axis is None:
+			return self.data.sum()
+		if axis == 0:
+			return bincount(self.indices, weights=self.data, minlength=self.shape[1])
+		return bincount(self._rowindices(), weights=self.data, minlength=self.shape[0])
+
+	def toarray(self):
+		mat = zeros(self.shape)
+		mat[self._rowindices(), self.indices] = self.data
+		return mat
+
+	def triplets(self):
+		return self._rowindices(), self.indices, self.data
 
 
 class ConfusionMatrix:
 	def __init__(self, mat, rownames, colnames, title=""):
-		self._mat = array(mat)
+		if isinstance(mat, SparseMatrix):
+			self._mat = mat
+		else:
+			self._mat = array(mat)
+			if self._mat.ndim != 2:  # matrix without rows
+				self._mat = self._mat.reshape(len(rownames), len(colnames))
 		self._rownames = rownames
 		self._colnames = colnames
 		self._rowindex = dict(zip(rownames, count()))
 		self._colindex = dict(zip(colnames, count()))
 		self.title = title
+		self._init_marginals()
+
+	def _init_marginals(self):
+		"""
+		pre-compute the class sizes (row and column sums) and the number of correct assignments per row and per
+		column, i.e. the cell in the column (row) with the same name, so that per-class measures are lookups
+		"""
+		rows, cols, values = self.triplets()
+		colpos = array([self._colindex.get(name, -1) for name in self._rownames], dtype=int64)
+		rowpos = array([self._rowindex.get(name, -1) for name in self._colnames], dtype=int64)
+		self._rowsums = self._mat.sum(axis=1)
+		self._colsums = self._mat.sum(axis=0)
+		diagonal = colpos[rows] == cols
+		self._rowcorrect = bincount(
+			rows[diagonal], weights=values[diagonal], minlength=len(colpos)).astype(self._rowsums.dtype)
+		diagonal = rowpos[cols] == rows
+		self._colcorrect = bincount(
+			cols[diagonal], weights=values[diagonal], minlength=len(rowpos)).astype(self._colsums.dtype)
+		self._rowknown = colpos >= 0  # row class is also a column class
+		self._colknown = rowpos >= 0  # column class is also a row class
 
-	# TODO: pre-compute sums to make operations constant in time
+	@staticmethod
+	def _selection(names, ignore_class):
+		return array([name not in ignore_class for name in names], dtype=bool)
+
+	@staticmethod
+	def _check_known(names, known, selection=True):
+		"""raise a KeyError for the first selected class which has no counterpart on the other axis"""
+		unknown = selection & ~known
+		if unknown.any():
+			raise KeyError(names[unknown.argmax()])
 
 	def recall_freqs(self):
-		for name, row in zip(self._rownames, self._mat):
-			size = row.sum()
-			cindex = self._colindex[name]
-			try:
-				correct = row[cindex]
-				if size:
-					yield name, size, correct
-			except KeyError:
-				pass
+		for name, size, correct, known in izip(self._rownames, self._rowsums, self._rowcorrect, self._rowknown):
+			if not known:
+				raise KeyError(name)
+			if size:
+				yield name, size, correct
 
 	_recall_freqs = recall_freqs
 
@@ -41,15 +193,9 @@ class ConfusionMatrix:
 		"""
 		try:
 			rindex = self._rowindex[name]
-			size = self._mat[rindex].sum()
 		except KeyError:
 			return 0, 0
-		try:
-			cindex = self._colindex[name]
-			correct = self._mat[rindex][cindex]  # TODO: format [a,b]?
-		except KeyError:
-			correct = 0
-		return size, correct
+		return self._rowsums[rindex], self._rowcorrect[rindex]
 
 	def _recalls(self):
 		for name, size, correct in self._recall_freqs():
@@ -64,52 +210,45 @@ class ConfusionMatrix:
 		size, correct = self.recall_freq(name)
 		return correct / float(size)
 
+	def _recall_selection(self, ignore_class):
+		self._check_known(self._rownames, self._rowknown)
+		return (self._rowsums != 0) & self._selection(self._rownames, ignore_class)
+
 	def macro_recall(self, ignore_class={""}):
-		recs = []
-		for name, rec in self.recall():
-			if name not in ignore_class:
-				recs.append(rec)
-		if recs:
+		selection = self._recall_selection(ignore_class)
+		recs = self._rowcorrect[selection] / self._rowsums[selection].astype(float)
+		if len(recs):
 			return mean(recs), std(recs), len(recs)
 		return float_nan, float_nan, 0
 
 	# same as accuracy!
 	def micro_recall(self, ignore_class={""}):
-		totalcorrect = 0
-		totalsize = 0
-		for name, size, correct in self._recall_freqs():
-			if name not in ignore_class and size:
-				totalcorrect += correct
-				totalsize += size
-		return totalcorrect / float(totalsize)
+		selection = self._recall_selection(ignore_class)
+		return float(self._rowcorrect[selection].sum()) / float(self._rowsums[selection].sum())
 
 	def accuracy(self, ignore_class={""}):
-		totalsize = 0
-		totalcorrect = 0
-		for name, row in zip(self._rownames, self._mat):
-			if name not in ignore_class:
-				totalsize += row.sum()
-				cindex = self._colindex[name]
-				try:
-					totalcorrect += row[cindex]
-				except KeyError:
-					pass
+		selection = self._selection(self._rownames, ignore_class)
+		self._check_known(self._rownames, self._rowknown, selection)
+		totalsize = self._rowsums[selection].sum()
 		if totalsize:
-			return totalcorrect / float(totalsize)
+			return self._rowcorrect[selection].sum() / float(totalsize)
 		return float_nan
 
 	def entropy_freqs(self, ignore_class={""}):
-		for i, name in enumerate(self._colnames):
-			if name in ignore_class:
-				continue
-			h_cluster = .0
-			col = self._mat[:, i]
-			size = float(col.sum())
-			for j, rname in zip(col, self._colnames):
-				if j and rname not in ignore_class:
-					p = j/size
-					h_cluster -= j*log(p, 2.)
-			yield name, h_cluster, size  # important: h_cluster is not entropy, but size*entropy
+		colselection = self._selection(self._colnames, ignore_class)
+		# the row classes are checked against the column names at the same position
+		rowselection = zeros(self._mat.shape[0], dtype=bool)
+		common = min(len(rowselection), len(colselection))
+		rowselection[:common] = colselection[:common]
+		rows, cols, values = self.triplets()
+		cells = rowselection[rows] & colselection[cols]
+		cols, values = cols[cells], values[cells]
+		sizes = self._colsums.astype(float)
+		h_clusters = 0. - bincount(
+			cols, weights=values * (array_log(values / sizes[cols]) / log(2.)), minlength=len(sizes))
+		for name, h_cluster, size, selected in izip(self._colnames, h_clusters.tolist(), sizes.tolist(), colselection):
+			if selected:
+				yield name, h_cluster, size  # important: h_cluster is not entropy, but size*entropy
 
 	def entropy(self, ignore_class={""}):  # as in doi://10.1093/bioinformatics/btm134
 		# stderr.write("entropy: {}\n".format(self._rowindex))
@@ -134,40 +273,23 @@ class ConfusionMatrix:
 		return h/tmp
 
 	def misclassification_rate(self, ignore_class={""}):
-		ignorecolindex = set()
-		for iclass in ignore_class:
-			try:
-				ignorecolindex.add(self._colindex[iclass])
-			except KeyError:
-				pass
-		totalreject = 0
-		totalsize = 0
-		totalcorrect = 0
-		for name, row in zip(self._rownames, self._mat):
-			if name not in ignore_class:
-				totalsize += row.sum()
-				cindex = self._colindex[name]
-				try:
-					totalcorrect += row[cindex]
-				except KeyError:
-					pass
-				for icolindex in ignorecolindex:
-					totalreject += row[icolindex]
-		if totalsize:
-			return (totalsize - totalcorrect - totalreject) / float(totalsize)
-		return float_nan
+		selection = self._selection(self._rownames, ignore_class)
+		self._check_known(self._rownames, self._rowknown, selection)
+		totalsize = self._rowsums[selection].sum()
+		if not totalsize:
+			return float_nan
+		totalcorrect = self._rowcorrect[selection].sum()
+		rows, cols, values = self.triplets()
+		rejected = selection[rows] & ~self._selection(self._colnames, ignore_class)[cols]
+		totalreject = values[rejected].sum()
+		return (totalsize - totalcorrect - totalreject) / float(totalsize)
 
 	def precision_freqs(self):
-		for name, i in zip(self._colnames, count()):
-			col = self._mat[:, i]
-			size = col.sum()
-			rindex = self._rowindex[name]
-			try:
-				correct = col[rindex]
-				if size:
-					yield name, size, correct
-			except KeyError:
-				pass
+		for name, size, correct, known in izip(self._colnames, self._colsums, self._colcorrect, self._colknown):
+			if not known:
+				raise KeyError(name)
+			if size:
+				yield name, size, correct
 
 	_precision_freqs = precision_freqs
 
@@ -177,15 +299,9 @@ class ConfusionMatrix:
 		"""
 		try:
 			cindex = self._colindex[name]
-			size = self._mat[:, cindex].sum()
 		except KeyError:
 			return 0, 0
-		try:
-			rindex = self._rowindex[name]
-			correct = self._mat[rindex][cindex]  # TODO: format [a,b]?
-		except KeyError:
-			correct = 0
-		return size, correct
+		return self._colsums[cindex], self._colcorrect[cindex]
 
 	def _precisions(self):
 		for name, size, correct in self._precision_freqs():
@@ -200,75 +316,56 @@ class ConfusionMatrix:
 		ret = self.precision_freq(name)
 		return ret[2] / float(ret[1])
 
+	def _precision_selection(self, ignore_class):
+		self._check_known(self._colnames, self._colknown)
+		return (self._colsums != 0) & self._selection(self._colnames, ignore_class)
+
 	def macro_precision(self, ignore_class={""}, truncate=0):
-		if not truncate:
-			precs = []
-			for name, prec in self.precision():
-				if name not in ignore_class:
-					precs.append(prec)
-		else:
-			totalsize = 0
-			precs_sizes = []
-			for name, size, correct in self._precision_freqs():
-				if name not in ignore_class:
-					totalsize += size
-					precs_sizes.append((size, correct / float(size)))
-			precs_sizes.sort(reverse=True)  # reverse sort from high to low bins
+		selection = self._precision_selection(ignore_class)
+		sizes = self._colsums[selection]
+		precs = self._colcorrect[selection] / sizes.astype(float)
+		if truncate:
+			totalsize = sum(sizes.tolist())  # summed in column order, the threshold is rounded up
+			order = lexsort((precs, sizes))[::-1]  # reverse sort from high to low bins
+			sizes, precs = sizes[order], precs[order]
 			if type(truncate) == float and truncate < 1.:
-				precs = []
-				lastsize = cumsize = 0
 				threshold = ceil(totalsize * truncate)
-				for size, prec in precs_sizes:
-					if cumsize > threshold and size < lastsize:  # treat equal size classes
-						break
-					precs.append(prec)
-					cumsize += size
-					lastsize = size
+				cumsizes = concatenate(([0], cumsum(sizes)[:-1]))  # size of all larger bins
+				lastsizes = concatenate(([0], sizes[:-1]))
+				stop = (cumsizes > threshold) & (sizes < lastsizes)  # treat equal size classes
+				if stop.any():
+					precs = precs[:stop.argmax()]
 			elif type(truncate) == int:
-				precs = [p[1] for p in precs_sizes[:truncate]]
 				try:
-					lastsize = precs_sizes[truncate - 1][0]  # TODO: format [a,b]?
-					for size, prec in precs_sizes[truncate - 1:]:
-						if size < lastsize:
-							break
-						precs.append(prec)
+					lastsize = sizes[truncate - 1]
 				except IndexError:
-					pass
+					precs = precs[:truncate]
+				else:  # keep equal size classes after the cut
+					precs = concatenate((precs[:truncate], precs[truncate - 1:][sizes[truncate - 1:] >= lastsize]))
 			else:
 				raise TypeError(
 					"truncate must either be the number of classes (integer) or a valid fraction (float) between 0 and 1")
-		if precs:
+		if len(precs):
 			return mean(precs), std(precs), len(precs)
 		return float_nan, float_nan, 0
 
 	# same as accuracy!
 	def micro_precision(self, ignore_class={""}):
-		totalcorrect = 0
-		totalsize = 0
-		for name, size, correct in self._precision_freqs():
-			if name not in ignore_class and size:
-				totalcorrect += correct
-				totalsize += size
-		return totalcorrect / float(totalsize)
+		selection = self._precision_selection(ignore_class)
+		return float(self._colcorrect[selection].sum()) / float(self._colsums[selection].sum())
 
 	def rand(self, ignore_class={""}):  # as in doi://10.1038/nmeth.3103
 		npair = lambda i: i*(i-1)  # not including division by 2 because we can often cancel it
-		all_pair_sum = 0.
-		total_sum = 0.
-		row_pair_sum = 0.
-		col_sums = zeros(self._mat.shape[1])  # ignore_class entry simply remains zero
-		for rname, row in zip(self._rownames, self._mat):
-			if rname in ignore_class:
-				continue
-			row_sum = 0.
-			for i, cname, val in zip(count(), self._colnames, row):
-				if cname in ignore_class:
-					continue
-				all_pair_sum += npair(val)
-				row_sum += val
-				col_sums[i] += val
-			total_sum += row_sum
-			row_pair_sum += npair(row_sum)
+		rowselection = self._selection(self._rownames, ignore_class)
+		colselection = self._selection(self._colnames, ignore_class)
+		rows, cols, values = self.triplets()
+		cells = rowselection[rows] & colselection[cols]
+		rows, cols, values = rows[cells], cols[cells], values[cells]
+		all_pair_sum = _running_sum(npair(values))
+		row_sums = bincount(rows, weights=values, minlength=self._mat.shape[0])
+		col_sums = bincount(cols, weights=values, minlength=self._mat.shape[1])  # ignore_class entry simply remains zero
+		total_sum = _running_sum(row_sums)
+		row_pair_sum = _running_sum(npair(row_sums))
 		col_pair_sum = npair(col_sums).sum()
 		#stderr.write("%.2f, %.2f, %.2f\n" % (all_pair_sum, row_pair_sum, col_pair_sum))
 		
@@ -287,6 +384,61 @@ class ConfusionMatrix:
 		arand = (all_pair_sum - t1) / tmp
 		return rand, arand
 
+	def all_metrics(self, ignore_class={""}, truncate=0):
+		"""
+		compute the summary measures and the per-class measures of the predicted classes in one call. The
+		supervised summary measures are NaN if a class has no counterpart on the other axis (as in sparse matrices),
+		where the individual methods raise a KeyError.
+
+		@param ignore_class: as in the individual methods
+		@type ignore_class: set[str]
+		@param truncate: as in macro_precision(), or a list of such values to get the summary measures for each of
+		them, which differ only in the precision fields
+		@type truncate: int | float | list[int | float]
+		@return: summary measures (fields of summary_metrics_dtype), or a list of them if truncate is a list, and
+		per-class measures (class_metrics_dtype) of all columns with non-zero size, in column order; the recall is
+		NaN for classes without real size
+		@rtype: (numpy.void | list[numpy.void], numpy.ndarray)
+		"""
+		summary = zeros((), dtype=summary_metrics_dtype)
+		for fields, measure in (
+				(("recall", "recall_std", "recall_classes"), lambda: self.macro_recall(ignore_class)),
+				(("accuracy",), lambda: (self.accuracy(ignore_class),)),
+				(("misclassification_rate",), lambda: (self.misclassification_rate(ignore_class),))):
+			try:
+				values = measure()
+			except KeyError:
+				values = (float_nan, float_nan, 0)
+			for field, value in izip(fields, values):
+				summary[field] = value
+		summary["entropy"] = self.entropy(ignore_class)
+		summary["rand"], summary["adjusted_rand"] = self.rand(ignore_class)
+
+		summaries = []
+		for truncation in truncate if isinstance(truncate, list) else [truncate]:
+			try:
+				values = self.macro_precision(ignore_class, truncation)
+			except KeyError:
+				values = (float_nan, float_nan, 0)
+			summary["precision"], summary["precision_std"], summary["precision_classes"] = values
+			summaries.append(summary.copy()[()])
+
+		selection = (self._colsums != 0).nonzero()[0]
+		rowpos = array([self._rowindex.get(self._colnames[i], -1) for i in selection], dtype=int64)
+		known = rowpos >= 0
+		classes = zeros(len(selection), dtype=class_metrics_dtype)
+		classes["name"] = [self._colnames[i] for i in selection]
+		classes["predicted_size"] = self._colsums[selection]
+		classes["correct"] = self._colcorrect[selection]
+		classes["precision"] = classes["correct"] / classes["predicted_size"]
+		classes["real_size"][known] = self._rowsums[rowpos[known]]
+		classes["recall"] = float_nan
+		real = classes["real_size"] != 0
+		classes["recall"][real] = self._rowcorrect[rowpos[real]] / classes["real_size"][real]
+		if isinstance(truncate, list):
+			return summaries, classes
+		return summaries[0], classes
+
 	def plot_matrix(
 		self, ignore_class={""}, title="", dpi=300, output=None, fmt=None, extratxt=None, axislabels=True,
 		groupcols=("red", "blue", "grey")):
@@ -442,8 +594,840 @@ class ConfusionMatrix:
 		for rname in self._rownames:
 			yield rname, self.get_row(rname)
 
+	def triplets(self):
+		"""
+		@return: row indices, column indices and values of all non-zero cells
+		@rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+		"""
+		if isinstance(self._mat, SparseMatrix):
+			return self._mat.triplets()
+		rows, cols = self._mat.nonzero()
+		return rows, cols, self._mat[rows, cols]
+
+
+class RankCounter:
+	"""
+	Weighted frequencies of (row class, column class) pairs for a single confusion matrix.
+
+	Class names are factorized into integer codes and the pair frequencies of each added
+	chunk are summed in bulk with bincount. Only the distinct pairs are kept in memory.
+	"""
+
+	def __init__(self, multiclass_separator=""):
+		self._separator = multiclass_separator
+		self._rowcodes = {}
+		self._colcodes = {}
+		self._keys = empty(0, dtype=int64)  # row code << 32 | column code
+		self._sums = empty(0, dtype=float)
+
+	@staticmethod
+	def _factorize(names, codes):
+		for name in set(names).difference(codes):
+			codes[name] = len(codes)
+		return array(map(codes.__getitem__, names), dtype=int64)
+
+	def _split_multiclass(self, rows, cols, weights):
+		sep = self._separator
+		srows, scols, sweights = [], [], []
+		for rclass, cclass, w in izip(rows, cols, weights):
+			for rsingle, csingle in product(rclass.split(sep), cclass.split(sep)):
+				srows.append(rsingle)
+				scols.append(csingle)
+				sweights.append(w)
+		return srows, scols, array(sweights, dtype=float)
+
+	def add(self, rows, cols, weights):
+		"""
+		@param rows: row class names
+		@type rows: Sequence[str]
+		@param cols: column class names, same length as rows
+		@type cols: Sequence[str]
+		@param weights: item weights, same length as rows
+		@type weights: numpy.ndarray
+		"""
+		if self._separator:
+			rows, cols, weights = self._split_multiclass(rows, cols, weights)
+		if not len(rows):
+			return
+		keys = (self._factorize(rows, self._rowcodes) << 32) | self._factorize(cols, self._colcodes)
+		keys = concatenate((self._keys, keys))
+		weights = concatenate((self._sums, weights))
+		self._keys, inverse = unique(keys, return_inverse=True)
+		self._sums = bincount(inverse, weights=weights)
+
+	def rownames(self):
+		"""row class names, ordered by code"""
+		return sorted(self._rowcodes, key=self._rowcodes.get)
+
+	def colnames(self):
+		"""column class names, ordered by code"""
+		return sorted(self._colcodes, key=self._colcodes.get)
+
+	def triplets(self):
+		"""
+		@return: row codes, column codes and summed weights of all non-zero cells
+		@rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+		"""
+		return self._keys >> 32, self._keys & 0xffffffff, self._sums
+
+
+def quadratic_axes(s1, s2, typeconv=None):
+	classes = list(s1 | s2)
+	if typeconv:
+		classes = map(typeconv, classes)
+		classes.sort()
+		classes = map(str, classes)
+	else:
+		classes.sort()
+	return classes, classes
+
+
+def sparse_axes(s1, s2, typeconv=None):
+	classes1 = list(s1)
+	classes2 = list(s2)
+	if typeconv:
+		classes1 = map(typeconv, classes1)
+		classes2 = map(typeconv, classes2)
+		classes1.sort()
+		classes2.sort()
+		classes1 = map(str, classes1)
+		classes2 = map(str, classes2)
+	else:
+		classes1.sort()
+		classes2.sort()
+	return classes1, classes2
+
+
+def missing_predictions(classes, class_for_missing_predictions):
+	"""TAB-separated classes for an item without prediction, one per rank of its labels"""
+	if classes is None:
+		return None
+	return "\t".join([class_for_missing_predictions] * (classes.count("\t") + 1))
+
+
+class ConfusionTableBuilder:
+	"""
+	Collects items with one row and one column class per rank and counts them into one
+	RankCounter per rank. Classes are given as TAB-separated strings, as in the RACOL format
+	without the leading identifier, and are split in bulk once chunksize items are buffered.
+	"""
+
+	def __init__(self, num_tables, multiclass_separator="", chunksize=2**17):
+		self.counters = [RankCounter(multiclass_separator) for i in xrange(num_tables)]
+		self.num_tables = num_tables
+		self.missing_labels = 0
+		self.missing_predictions = 0
+		self._separator = multiclass_separator
+		self._chunksize = chunksize
+		self._rows = []
+		self._cols = []
+		self._weights = []
 
-def parse_confusion_matrix(lines):
+	def add(self, rowclasses, colclasses, weight):
+		"""
+		Add one item. Classes beyond the shorter of both lists are ignored like with zip().
+
+		@param rowclasses: TAB-separated row classes or None if there are none
+		@type rowclasses: str | None
+		@param colclasses: TAB-separated column classes or None if there are none
+		@type colclasses: str | None
+		@param weight: item weight
+		@type weight: float
+		"""
+		self._rows.append(rowclasses)
+		self._cols.append(colclasses)
+		self._weights.append(weight)
+		if len(self._rows) >= self._chunksize:
+			self.flush()
+
+	def flush(self):
+		rows, cols = self._rows, self._cols
+		if not rows:
+			return
+		weights = array(self._weights, dtype=float)
+		self._rows, self._cols, self._weights = [], [], []
+		num_tables = self.num_tables
+		tabs = [num_tables - 1] * len(rows)
+		if None not in rows and None not in cols and map(str.count, rows, "\t" * len(rows)) == tabs \
+			and map(str.count, cols, "\t" * len(cols)) == tabs:
+			rowfields = "\t".join(rows).split("\t")
+			colfields = "\t".join(cols).split("\t")
+			for i in xrange(num_tables):
+				self._add(i, rowfields[i::num_tables], colfields[i::num_tables], weights)
+			return
+		# items with fewer columns only contribute to the leading ranks
+		rows = [[] if r is None else r.split("\t") for r in rows]
+		cols = [[] if c is None else c.split("\t") for c in cols]
+		for i in xrange(num_tables):
+			keep = [j for j in xrange(len(rows)) if len(rows[j]) > i and len(cols[j]) > i]
+			self._add(i, [rows[j][i] for j in keep], [cols[j][i] for j in keep], weights[keep])
+
+	def _add(self, rank, rows, cols, weights):
+		self.counters[rank].add(rows, cols, weights)
+
+	def _counter(self, rank):
+		return self.counters[rank]
+
+	def count(self, joined, class_for_missing_predictions=None):
+		"""
+		Add the items of a join (see join_racol) and count the identifiers which are missing on
+		either side in missing_labels and missing_predictions.
+
+		@param joined: identifier, label classes, predicted classes and weight of each item
+		@type joined: Iterable[(str, str | None, str | None, float | None)]
+		@param class_for_missing_predictions: labeled items without prediction are added with this
+		class on all ranks, they are only counted if None
+		@type class_for_missing_predictions: str | None
+		"""
+		for name, label, prediction, weight in joined:
+			if label is no_entry:
+				self.missing_labels += 1
+			elif prediction is no_entry:
+				self.missing_predictions += 1
+				if class_for_missing_predictions is not None:
+					self.add(label, missing_predictions(label, class_for_missing_predictions), weight)
+			else:
+				self.add(label, prediction, weight)
+		self.flush()
+
+	def table(self, rank, matrix_form="sparse", numeric_classes=False, sort_rows=False, sort_cols=False):
+		"""
+		Lay out the counts of one rank as a confusion matrix.
+
+		@param rank: index of the rank (RACOL column after the identifier)
+		@type rank: int
+		@param matrix_form: "sparse" for the observed row and column classes, "quadratic" for
+		their union on both axes
+		@type matrix_form: str
+		@param numeric_classes: order classes by their integer value instead of alphabetically
+		@type numeric_classes: bool
+		@param sort_rows: order rows by decreasing numbers instead
+		@type sort_rows: bool
+		@param sort_cols: order columns by decreasing numbers instead
+		@type sort_cols: bool
+		@return: row classes, column classes and the row positions, column positions and values of
+		all non-zero cells
+		@rtype: (list[str], list[str], list[int], list[int], list[float])
+		"""
+		self.flush()
+		counter = self._counter(rank)
+		rownames, colnames = counter.rownames(), counter.colnames()
+		rcodes, ccodes, values = counter.triplets()
+		rcodes, ccodes, values = rcodes.tolist(), ccodes.tolist(), values.tolist()
+		axes = quadratic_axes if matrix_form == "quadratic" else sparse_axes
+		classes = set(rownames), set(colnames)
+		if numeric_classes:
+			row_classes, column_classes = axes(*classes, typeconv=int)
+		else:
+			row_classes, column_classes = axes(*classes)
+
+		if sort_cols or sort_rows:
+			table = dict(((rownames[r], colnames[c]), v) for r, c, v in izip(rcodes, ccodes, values))
+
+		if sort_cols:  # sort columns by decreasing numbers
+			column_classes = zip(*sorted([([table.get((crow, ccol), 0) for crow in row_classes], ccol) for ccol in column_classes], reverse=True))[1]
+
+		if sort_rows:  # sort rows by decreasing numbers
+			row_classes = zip(*sorted([([table.get((crow, ccol), 0) for ccol in column_classes], crow) for crow in row_classes], reverse=True))[1]
+
+		# look up the cells of each output row and column by class name
+		rowcode = dict(izip(rownames, count()))
+		colcode = dict(izip(colnames, count()))
+		colpos = [[] for ccol in colnames]
+		for i, ccol in enumerate(column_classes):
+			if ccol in colcode:
+				colpos[colcode[ccol]].append(i)
+		cells = [[] for crow in rownames]
+		for r, c, v in izip(rcodes, ccodes, values):
+			cells[r].append((c, v))
+		rows, cols, values = [], [], []
+		for i, crow in enumerate(row_classes):
+			if crow in rowcode:
+				for c, v in cells[rowcode[crow]]:
+					for j in colpos[c]:
+						rows.append(i)
+						cols.append(j)
+						values.append(v)
+		return list(row_classes), list(column_classes), rows, cols, values
+
+
+class RankSpool(ConfusionTableBuilder):
+	"""
+	ConfusionTableBuilder which does not count but writes the row classes, column classes and
+	weights of each rank to its own temporary files (in $TMPDIR by default). Each rank can then be
+	counted and laid out independently by table(), e.g. in worker processes (see parallel_tables).
+	Call remove() to delete the files.
+	"""
+
+	def __init__(self, num_tables, multiclass_separator="", chunksize=2**17, tmpdir=None):
+		ConfusionTableBuilder.__init__(self, 0, multiclass_separator, chunksize)
+		self.num_tables = num_tables
+		self._chunks = [[] for i in xrange(num_tables)]  # number of items per written chunk
+		self._paths = []
+		self._files = []
+		for i in xrange(num_tables):
+			paths = [mkstemp(prefix="cmat-spool-", dir=tmpdir) for j in xrange(3)]
+			self._paths.append([p for fd, p in paths])
+			self._files.append([fdopen(fd, "wb") for fd, p in paths])
+
+	def __getstate__(self):  # for worker processes, which only read the files
+		state = self.__dict__.copy()
+		state["_files"] = None
+		return state
+
+	def _add(self, rank, rows, cols, weights):
+		# one line of TAB-separated classes per chunk, classes never contain TABs or newlines
+		rowfile, colfile, weightfile = self._files[rank]
+		rowfile.write("\t".join(rows) + "\n")
+		colfile.write("\t".join(cols) + "\n")
+		weights.astype(float).tofile(weightfile)
+		self._chunks[rank].append(len(rows))
+
+	def flush(self):
+		ConfusionTableBuilder.flush(self)
+		if self._files:
+			for files in self._files:
+				for f in files:
+					f.flush()
+
+	def _counter(self, rank):
+		counter = RankCounter(self._separator)
+		rowpath, colpath, weightpath = self._paths[rank]
+		with open(rowpath) as rowfile, open(colpath) as colfile, open(weightpath, "rb") as weightfile:
+			for size in self._chunks[rank]:
+				rows = rowfile.readline()[:-1].split("\t")
+				cols = colfile.readline()[:-1].split("\t")
+				weights = fromfile(weightfile, dtype=float, count=size)
+				if size:
+					counter.add(rows, cols, weights)
+		return counter
+
+	def remove(self):
+		if self._files:
+			for files in self._files:
+				for f in files:
+					f.close()
+		for paths in self._paths:
+			for p in paths:
+				remove(p)
+		self._paths = []
+
+
+def _spooled_table(args):
+	spool, rank, title, binary, tmpdir, layout = args
+	rownames, colnames, rows, cols, values = spool.table(rank, **layout)
+	if binary:
+		return title, rownames, colnames, rows, cols, values
+	fd, path = mkstemp(prefix="cmat-", dir=tmpdir)
+	with fdopen(fd, "w") as f:
+		write_confusion_matrix(f, title, rownames, colnames, rows, cols, values)
+	return path
+
+
+def parallel_tables(spool, ranks, titles, jobs, binary=False, tmpdir=None, **layout):
+	"""
+	Count and lay out ranks of a RankSpool in worker processes, each rank is handled by one worker.
+
+	@param ranks: ranks in output order
+	@type ranks: Sequence[int]
+	@param titles: title of each rank
+	@type titles: Sequence[str]
+	@param jobs: number of worker processes
+	@type jobs: int
+	@param binary: return the table layouts instead of the text form
+	@type binary: bool
+	@param layout: matrix_form, numeric_classes, sort_rows and sort_cols of ConfusionTableBuilder.table
+
+	@return: for each rank in order, the name of a temporary file with the text form (to be
+	removed by the caller) or, if binary, title, row classes, column classes and the rows,
+	columns and values of the non-zero cells
+	@rtype: Iterator[str | tuple]
+	"""
+	from multiprocessing import Pool
+	spool.flush()
+	pool = Pool(min(jobs, len(ranks)) or 1)
+	try:
+		for result in pool.imap(_spooled_table, [(spool, rank, titles[rank], binary, tmpdir, layout) for rank in ranks]):
+			yield result
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def _identifier(line):
+	return line.partition("\t")[0]
+
+
+def _spill(lines, tmpdir):
+	lines.sort(key=_identifier)
+	run = TemporaryFile(dir=tmpdir)
+	run.writelines(lines)
+	run.seek(0)
+	return run
+
+
+def external_sort(lines, buffer_size=2**30, tmpdir=None, comments=True):
+	"""
+	Sort lines by their first TAB-separated field using a bounded amount of memory.
+
+	Whenever about buffer_size bytes of lines are held, they are sorted and spilled to a
+	temporary file. The sorted runs are merged lazily while iterating the result.
+
+	@param lines: input lines, e.g. an open RACOL or weights file
+	@type lines: Iterable[str]
+	@param buffer_size: approximate number of bytes to hold in memory
+	@type buffer_size: int
+	@param tmpdir: directory for temporary files, $TMPDIR by default
+	@type tmpdir: str | None
+	@param comments: skip lines starting with "#"
+	@type comments: bool
+
+	@rtype: Iterator[str]
+	"""
+	runs = []
+	chunk = []
+	size = 0
+	for line in lines:
+		if comments and line[0] == "#":
+			continue
+		if line[-1] != "\n":
+			line += "\n"
+		chunk.append(line)
+		size += len(line) + 64  # rough per-line overhead of Python strings and lists
+		if size >= buffer_size:
+			runs.append(_spill(chunk, tmpdir))
+			chunk = []
+			size = 0
+	chunk.sort(key=_identifier)
+	if not runs:
+		return iter(chunk)
+	runs.append(chunk)
+	return (line for key, line in merge(*[((_identifier(line), line) for line in run) for run in runs]))
+
+
+def _split_racol(lines):
+	for line in lines:
+		name, tab, classes = line.rstrip("\n").partition("\t")
+		if not tab:
+			classes = None
+		yield name, classes
+
+
+def merge_join(labels, predictions):
+	"""
+	Join two RACOL streams which are sorted by identifier (see external_sort).
+
+	@return: identifier, TAB-separated label classes and predicted classes; the classes of a side
+	which has no line for the identifier are no_entry, None means no classes at all
+	@rtype: Iterator[(str, str | None, str | None)]
+	"""
+	end = (None, None)
+	labels = _split_racol(labels)
+	predictions = _split_racol(predictions)
+	label = next(labels, end)
+	prediction = next(predictions, end)
+	while label is not end and prediction is not end:
+		if label[0] == prediction[0]:
+			yield label[0], label[1], prediction[1]
+			label = next(labels, end)
+			prediction = next(predictions, end)
+		elif label[0] < prediction[0]:
+			yield label[0], label[1], no_entry
+			label = next(labels, end)
+		else:
+			yield prediction[0], no_entry, prediction[1]
+			prediction = next(predictions, end)
+	while label is not end:
+		yield label[0], label[1], no_entry
+		label = next(labels, end)
+	while prediction is not end:
+		yield prediction[0], no_entry, prediction[1]
+		prediction = next(predictions, end)
+
+
+def merge_weights(joined, weights):
+	"""
+	Attach weights to the output of merge_join.
+
+	@param weights: lines with identifier and weight, sorted by identifier (see external_sort)
+	@type weights: Iterable[str]
+
+	@return: identifier, label classes, predicted classes and weight, which is None for
+	identifiers without a label
+	@rtype: Iterator[(str, str | None, str | None, float | None)]
+	@raise KeyError: if a labeled identifier has no weight
+	"""
+	weights = (line.strip().split("\t", 2)[:2] for line in weights)
+	current = next(weights, None)
+	for name, label, prediction in joined:
+		if label is no_entry:
+			yield name, label, prediction, None
+			continue
+		while current is not None and current[0] < name:
+			current = next(weights, None)
+		if current is None or current[0] != name:
+			raise KeyError(name)
+		yield name, label, prediction, float(current[1])
+
+
+class oneweight:
+	"""dummy weights counting each item as one"""
+	__getitem__ = lambda self, key: 1
+
+
+def read_weights(lines):
+	"""
+	@param lines: lines with identifier and weight
+	@type lines: Iterable[str]
+	@rtype: dict[str, float]
+	"""
+	weight = {}
+	for line in lines:
+		name, w = line.strip().split("\t", 2)[:2]
+		weight[name] = float(w)
+	return weight
+
+
+def lockstep_join(labels, predictions, weight):
+	"""
+	Join two RACOL streams in any order by reading both alternately. Unmatched lines are cached
+	in memory until their partner line is read, the remaining ones are missing on the other side.
+
+	@param weight: item weights by identifier
+	@type weight: Mapping[str, float]
+
+	@return: like merge_weights; an item whose weight is missing is treated as unmatched
+	@rtype: Iterator[(str, str | None, str | None, float | None)]
+	"""
+	cache = ({}, {})
+	inputs = (iter(labels), iter(predictions))
+	not_empty = [True, True]
+
+	while any(not_empty):
+		# read one line of each input and yield pairs as soon as both sides are known
+		for index_this, index_other in ((0, 1), (1, 0)):
+			if not_empty[index_this]:
+				try:
+					line = inputs[index_this].next()
+				except StopIteration:
+					not_empty[index_this] = False
+					continue
+				if line[0] != "#":
+					name, tab, classes = line.rstrip("\n").partition("\t")
+					if not tab:
+						classes = None
+
+					try:
+						classes_cached = cache[index_other].pop(name)  # look in cache
+						w = weight[name]
+					except KeyError:
+						cache[index_this][name] = classes  # put into cache
+						continue
+					if index_this == 0:
+						yield name, classes, classes_cached, w
+					else:
+						yield name, classes_cached, classes, w
+
+	for name, classes in cache[1].iteritems():
+		yield name, no_entry, classes, None
+	for name, classes in cache[0].iteritems():
+		yield name, classes, no_entry, weight[name]
+
+
+def join_racol(labels, predictions, weights=None, sort_join=False, buffer_size=2**30, tmpdir=None):
+	"""
+	Join label and prediction RACOL lines by identifier and attach the item weights.
+
+	@param weights: weights by identifier, lines with identifier and weight or None to count each
+	item as one
+	@type weights: Mapping[str, float] | Iterable[str] | None
+	@param sort_join: sort the inputs with bounded memory (see external_sort) and merge them
+	(see merge_join) instead of the lockstep_join
+	@type sort_join: bool
+	@param buffer_size: memory for sorting, shared by all sorted inputs
+	@type buffer_size: int
+
+	@return: like merge_weights
+	@rtype: Iterator[(str, str | None, str | None, float | None)]
+	"""
+	if not sort_join:
+		if weights is None:
+			weights = oneweight()
+		elif not hasattr(weights, "keys"):
+			weights = read_weights(weights)
+		return lockstep_join(labels, predictions, weights)
+
+	if weights is None or hasattr(weights, "keys"):
+		buffer_size /= 2
+	else:
+		buffer_size /= 3
+	joined = merge_join(
+		external_sort(labels, buffer_size, tmpdir), external_sort(predictions, buffer_size, tmpdir))
+	if weights is None:
+		return ((name, label, prediction, 1) for name, label, prediction in joined)
+	if hasattr(weights, "keys"):
+		return (
+			(name, label, prediction, None if label is no_entry else weights[name])
+			for name, label, prediction in joined)
+	return merge_weights(joined, external_sort(weights, buffer_size, tmpdir, comments=False))
+
+
+def racol_titles(firstline, title=""):
+	"""
+	@param firstline: first line of a RACOL file, the rank names are taken from a header line
+	("#identifier\trank1\trank2...")
+	@type firstline: str
+	@param title: title of all matrices if there is no header
+	@type title: str
+	@rtype: list[str]
+	"""
+	num_tables = firstline.count("\t")
+	if firstline[0] == "#":
+		return firstline[1:].strip().split("\t")[1:]
+	if title:
+		return [title for i in xrange(num_tables)]
+	return ["confusion matrix" for i in xrange(num_tables)]
+
+
+def _racol_lines(items):
+	for item in items:
+		if isinstance(item, basestring):
+			yield item
+		else:
+			yield "\t".join(map(str, item)) + "\n"
+
+
+def confusion_matrices(
+	labels, predictions, weights=None, title="", matrix_form="sparse", numeric_classes=False,
+	multiclass_separator="", class_for_missing_predictions=None, allow_missing_labels=False,
+	sort_rows=False, sort_cols=False, sort_join=False, buffer_size=2**30):
+	"""
+	Compute the confusion matrices of all ranks in-process, like the confusionmatrix script.
+
+	@param labels: RACOL lines or sequences of fields (identifier and one class per rank), an
+	optional header line names the ranks
+	@type labels: Iterable[str | Sequence]
+	@param predictions: RACOL lines or sequences of fields
+	@type predictions: Iterable[str | Sequence]
+	@param weights: see join_racol
+	@type weights: Mapping[str, float] | Iterable[str] | None
+	@param class_for_missing_predictions: see ConfusionTableBuilder.count, missing predictions
+	are an error if None
+	@type class_for_missing_predictions: str | None
+	@param allow_missing_labels: ignore predicted items without label instead of an error
+	@type allow_missing_labels: bool
+
+	The other parameters are those of ConfusionTableBuilder, racol_titles,
+	ConfusionTableBuilder.table and join_racol.
+
+	@return: one matrix per rank, in rank order
+	@rtype: list[ConfusionMatrix]
+	@raise ValueError: for missing labels or predictions which are not allowed
+	"""
+	labels = _racol_lines(labels)
+	try:
+		firstline = labels.next()
+	except StopIteration:
+		raise ValueError("no labels given")
+	titles = racol_titles(firstline, title)
+	builder = ConfusionTableBuilder(firstline.count("\t"), multiclass_separator)
+	builder.count(
+		join_racol(chain((firstline,), labels), _racol_lines(predictions), weights, sort_join, buffer_size),
+		class_for_missing_predictions)
+	if builder.missing_labels and not allow_missing_labels:
+		raise ValueError("%i predicted entries are missing in the labels" % builder.missing_labels)
+	if builder.missing_predictions and class_for_missing_predictions is None:
+		raise ValueError("%i labeled entries are missing in the predictions" % builder.missing_predictions)
+
+	cmats = []
+	for rank, title in enumerate(titles):
+		rownames, colnames, rows, cols, values = builder.table(
+			rank, matrix_form, numeric_classes, sort_rows, sort_cols)
+		mat = SparseMatrix.from_triplets(rows, cols, values, (len(rownames), len(colnames)))
+		cmats.append(ConfusionMatrix(mat, rownames, colnames, title))
+	return cmats
+
+
+def write_confusion_matrix(stream, title, rownames, colnames, rows, cols, values):
+	"""
+	Write a confusion matrix in text form, all cells not given are zero.
+
+	@param rows: row indices of the non-zero cells
+	@type rows: Sequence[int]
+	@param cols: column indices of the non-zero cells
+	@type cols: Sequence[int]
+	@param values: cell values
+	@type values: Sequence[float]
+	"""
+	cells = [[] for rname in rownames]
+	for r, c, v in izip(rows, cols, values):
+		cells[r].append((c, v))
+	stream.write("%s\t%s\n" % (title, "\t".join(colnames)))
+	zero_line = ["%.2f" % 0] * len(colnames)
+	for rname, row_cells in izip(rownames, cells):
+		line = list(zero_line)
+		for c, v in row_cells:
+			line[c] = "%.2f" % v
+		stream.write("%s\t%s\n" % (rname, "\t".join(line)))
+	stream.write("\n\n")
+
+
+def _aligned(offset):
+	return (offset + 7) & ~7
+
+
+def write_confusion_matrices_binary(stream, matrices):
+	"""
+	Write confusion matrices in the binary container format.
+
+	The file starts with the line binary_magic, followed by the header size as 8-byte unsigned
+	integer and the header with one TAB-separated line per matrix: title, number of rows,
+	number of columns, number of non-zero cells and the offset of the row indices (int32), the
+	column indices (int32), the values (float64) as well as offset and size of the newline-separated
+	row and column names. All numbers are little endian, offsets are relative to the 8-byte
+	aligned start of the data section following the header and are multiples of 8.
+
+	@param matrices: title, row names, column names, row indices, column indices and values of
+	the non-zero cells for each matrix
+	@type matrices: Iterable[(str, list[str], list[str], Sequence[int], Sequence[int], Sequence[float])]
+	"""
+	header = []
+	blocks = []
+	offset = 0
+	for title, rownames, colnames, rows, cols, values in matrices:
+		fields = [title, len(rownames), len(colnames), len(values)]
+		for block in (
+			array(rows, dtype="<i4").tostring(), array(cols, dtype="<i4").tostring(),
+			array(values, dtype="<f8").tostring()):
+			blocks.append((offset, block))
+			fields.append(offset)
+			offset = _aligned(offset + len(block))
+		for block in ("\n".join(rownames), "\n".join(colnames)):
+			blocks.append((offset, block))
+			fields.extend((offset, len(block)))
+			offset = _aligned(offset + len(block))
+		header.append("\t".join(map(str, fields)))
+	header = "\n".join(header)
+	stream.write(binary_magic)
+	stream.write(pack("<Q", len(header)))
+	stream.write(header)
+	start = len(binary_magic) + 8 + len(header)
+	stream.write("\0" * (_aligned(start) - start))
+	position = 0
+	for offset, block in blocks:
+		stream.write("\0" * (offset - position))
+		stream.write(block)
+		position = offset + len(block)
+
+
+def write_confusion_matrices(stream, cmats, binary=False):
+	"""write ConfusionMatrix objects in text or binary form"""
+	if binary:
+		write_confusion_matrices_binary(
+			stream, ((cmat.title, cmat._rownames, cmat._colnames) + cmat.triplets() for cmat in cmats))
+		return
+	for cmat in cmats:
+		rows, cols, values = cmat.triplets()
+		write_confusion_matrix(
+			stream, cmat.title, cmat._rownames, cmat._colnames, rows.tolist(), cols.tolist(), values.tolist())
+
+
+def _binary_buffer(firstline, lines):
+	try:
+		buf = mmap(lines.fileno(), 0, access=ACCESS_READ)
+		if buf[:len(binary_magic)] == binary_magic:
+			return buf
+	except (AttributeError, EnvironmentError, ValueError):  # not a regular file, e.g. a pipe
+		pass
+	return firstline + "".join(lines)
+
+
+def _binary_index(buf):
+	"""title, data offset and sizes/offsets of all matrices in the header of the binary form"""
+	start = len(binary_magic) + 8
+	header = buf[start:start + unpack_from("<Q", buf, len(binary_magic))[0]]
+	data = _aligned(start + len(header))
+	index = []
+	for line in header.split("\n") if header else ():
+		fields = line.split("\t")
+		index.append((fields[0], data, map(int, fields[1:])))
+	return index
+
+
+def _binary_confusion_matrix(buf, title, data, fields):
+	nrows, ncols, nnz, orows, ocols, ovalues, orownames, lrownames, ocolnames, lcolnames = fields
+	rownames = buf[data + orownames:data + orownames + lrownames].split("\n") if nrows else []
+	colnames = buf[data + ocolnames:data + ocolnames + lcolnames].split("\n") if ncols else []
+	if nnz:
+		rows = frombuffer(buf, dtype="<i4", count=nnz, offset=data + orows)
+		cols = frombuffer(buf, dtype="<i4", count=nnz, offset=data + ocols)
+		values = frombuffer(buf, dtype="<f8", count=nnz, offset=data + ovalues)
+	else:
+		rows = cols = values = ()
+	mat = SparseMatrix.from_triplets(rows, cols, values, (nrows, ncols))
+	return ConfusionMatrix(mat, rownames, colnames, title)
+
+
+def _load_confusion_matrices_binary(buf, titles=None):
+	for title, data, fields in _binary_index(buf):
+		if titles is None or title in titles:
+			yield _binary_confusion_matrix(buf, title, data, fields)
+
+
+def _text_confusion_matrix(header, rows):
+	"""
+	build a confusion matrix from the title line and the row lines of the text form, the numbers are converted in
+	blocks of rows of about text_block_cells cells and only the non-zero cells are kept
+	"""
+	header = header.rstrip("\n").split("\t")
+	title, colnames = header[0], header[1:]
+	ncols = len(colnames)
+	block_rows = max(1, text_block_cells // max(ncols, 1))
+	rownames = []
+	indptr = [0]
+	indices = []
+	data = []
+	cells = []
+	for number, row in enumerate(rows):
+		row = row.rstrip("\n")
+		if row.count("\t") != ncols:
+			raise ValueError("malformed confusion matrix '%s': expected %i numbers in row %i" % (title, ncols, number + 1))
+		name, _, row = row.partition("\t")
+		rownames.append(name)
+		cells.append(row)
+		if len(cells) == block_rows:
+			_sparse_text_block(title, cells, ncols, indptr, indices, data)
+			cells = []
+	if cells:
+		_sparse_text_block(title, cells, ncols, indptr, indices, data)
+	mat = SparseMatrix(
+		array(indptr), concatenate(indices) if indices else empty(0, dtype=int64),
+		concatenate(data) if data else empty(0), (len(rownames), ncols))
+	return ConfusionMatrix(mat, rownames, colnames, title)
+
+
+def _sparse_text_block(title, cells, ncols, indptr, indices, data):
+	"""append the non-zero cells of a block of text rows to the CSR arrays"""
+	if not ncols:
+		indptr.extend([0] * len(cells))
+		return
+	values = fromstring("\t".join(cells), sep="\t")
+	if len(values) != len(cells) * ncols:
+		raise ValueError("malformed confusion matrix '%s': expected %i numbers per row" % (title, ncols))
+	rows, cols = values.reshape((len(cells), ncols)).nonzero()  # in row-major order, i.e. already sorted
+	indptr.extend(indptr[-1] + cumsum(bincount(rows, minlength=len(cells))))
+	indices.append(cols)
+	data.append(values[rows * ncols + cols])
+
+
+def parse_confusion_matrix(lines, titles=None):
+	"""
+	parse confusion matrices in text form or, if the input starts with binary_magic, in binary form
+
+	@param titles: parse only the matrices with these titles, others are skipped
+	@type titles: set[str] | None
+	"""
 	line = None
 	try:
 		while True:
@@ -451,22 +1435,20 @@ def parse_confusion_matrix(lines):
 			while not line or line == "\n" or line[0] == '#':
 				line = lines.next()
 
-			line = line.rstrip("\n").split("\t")
-			title, colnames = line[0], line[1:]
+			if line == binary_magic:  # memory-mapped if the input is a regular file
+				for cmat in _load_confusion_matrices_binary(_binary_buffer(line, lines), titles):
+					yield cmat
+				return
 
+			header = line
 			rows = []
-			rownames = []
-
 			for line in lines:
 				if line == "\n":  # stop at empty line
 					break
-				line = line.rstrip("\n").split("\t")
-				rownames.append(line[0])
-				rows.append(map(float, line[1:]))
+				rows.append(line)
 
-			# construct numpy matrix
-			# cmat = array( rows )
-			yield ConfusionMatrix(rows, rownames, colnames, title)
+			if titles is None or header.split("\t", 1)[0].rstrip("\n") in titles:
+				yield _text_confusion_matrix(header, rows)
 			line = lines.next()
 
 	except StopIteration:
@@ -475,3 +1457,149 @@ def parse_confusion_matrix(lines):
 # TODO: consistent naming scheme (underscore); transitional for backwards compatibility
 parseConfusionMatrix = parse_confusion_matrix
 
+
+class ConfusionMatrixFile:
+	"""
+	Random access to the confusion matrices in a regular file (text or binary form). The file is memory-mapped
+	and scanned once for the matrix boundaries and titles. The resulting offset index can be saved to and loaded
+	from index_path (which is tied to size and modification time of the file) and a matrix is only parsed when it
+	is requested.
+	"""
+
+	index_signature = "# confusion matrix index"
+
+	def __init__(self, stream, index_path=None):
+		"""
+		@param stream: regular file opened for reading
+		@type stream: file
+		@param index_path: file to load the offset index from or to save it to, if it is missing or outdated
+		@type index_path: str | None
+		"""
+		try:
+			self._buf = mmap(stream.fileno(), 0, access=ACCESS_READ)
+		except ValueError:  # empty file
+			self._buf = ""
+		self._binary = self._buf[:len(binary_magic)] == binary_magic
+		if self._binary:
+			self._index = _binary_index(self._buf)
+			return
+		stat = fstat(stream.fileno())
+		signature = "%s\t%i\t%r\n" % (self.index_signature, stat.st_size, stat.st_mtime)
+		self._index = self._load_index(index_path, signature) if index_path else None
+		if self._index is None:
+			self._index = self._scan()
+			if index_path:
+				self._save_index(index_path, signature)
+
+	def _scan(self):
+		"""title, start of the title line and end of the rows for each matrix in text form"""
+		buf = self._buf
+		index = []
+		size = len(buf)
+		pos = 0
+		while pos < size:
+			eol = buf.find("\n", pos)
+			if eol < 0:
+				eol = size
+			if eol == pos or buf[pos] == "#":  # eat white space and comments
+				pos = eol + 1
+				continue
+			end = buf.find("\n\n", eol)  # stop at empty line
+			end = size if end < 0 else end + 1
+			index.append((buf[pos:eol].split("\t", 1)[0], pos, end))
+			pos = end + 1
+		return index
+
+	def _load_index(self, path, signature):
+		try:
+			with open(path) as f:
+				if f.readline() != signature:
+					return None
+				index = []
+				for line in f:
+					title, start, end = line.rstrip("\n").split("\t")
+					index.append((title, int(start), int(end)))
+				return index
+		except (EnvironmentError, ValueError):
+			return None
+
+	def _save_index(self, path, signature):
+		tmppath = "%s.%i.tmp" % (path, getpid())
+		try:
+			with open(tmppath, "w") as f:
+				f.write(signature)
+				for entry in self._index:
+					f.write("%s\t%i\t%i\n" % entry)
+			rename(tmppath, path)  # atomic, other readers see a complete index or none
+		except EnvironmentError, err:
+			print >> stderr, "cannot save confusion matrix index: %s" % err
+
+	def _load(self, entry):
+		if self._binary:
+			return _binary_confusion_matrix(self._buf, *entry)
+		title, start, end = entry
+		lines = self._buf[start:end].split("\n")
+		if lines[-1] == "":  # line break of the last row
+			lines.pop()
+		return _text_confusion_matrix(lines[0], lines[1:])
+
+	def titles(self):
+		"""
+		@rtype: list[str]
+		"""
+		return [entry[0] for entry in self._index]
+
+	def __len__(self):
+		return len(self._index)
+
+	def __iter__(self):
+		for entry in self._index:
+			yield self._load(entry)
+
+	def __getitem__(self, title):
+		"""
+		@rtype: ConfusionMatrix
+		"""
+		for entry in self._index:
+			if entry[0] == title:
+				return self._load(entry)
+		raise KeyError(title)
+
+	def select(self, titles):
+		"""
+		@param titles: titles of the requested matrices, they are returned in file order
+		@type titles: set[str]
+		@rtype: collections.Iterable[ConfusionMatrix]
+		"""
+		for entry in self._index:
+			if entry[0] in titles:
+				yield self._load(entry)
+
+
+def read_confusion_matrices(stream, titles=None, index_path=None):
+	"""
+	iterate over the confusion matrices in stream, in file order. A regular file is indexed (see
+	ConfusionMatrixFile) and only the selected matrices are parsed, other streams are parsed sequentially.
+
+	@param stream: open file or file name, the offset index of a file name is saved next to it
+	@type stream: file | str
+	@param titles: read only the matrices with these titles
+	@type titles: set[str] | None
+	@param index_path: location of the saved offset index of a regular file
+	@type index_path: str | None
+	@rtype: collections.Iterable[ConfusionMatrix]
+	"""
+	if isinstance(stream, basestring):
+		if index_path is None:
+			index_path = stream + index_suffix
+		stream = open(stream)
+	try:
+		regular = S_ISREG(fstat(stream.fileno()).st_mode)
+	except (AttributeError, EnvironmentError):
+		regular = False
+	if not regular:
+		return parse_confusion_matrix(stream, titles)
+	cmats = ConfusionMatrixFile(stream, index_path)
+	if titles is None:
+		return iter(cmats)
+	return cmats.select(titles)
@@ -0,0 +1,441 @@
+"""
+Compiled form of the NCBI taxonomy dump files which is memory-mapped instead of parsed.
+
+The file holds the parent taxid (int32) and rank code (uint8) of each node in arrays indexed by taxid, the
+scientific names as an offset-indexed blob, the merged ids as two sorted int32 arrays and the lowercased names and
+synonyms (keys of NcbiTaxonomy.name_to_taxids) as a sorted blob with the taxids of each name. A table of the
+ancestors of each node at the legal ranks makes lineages a row lookup.
+"""
+
+import os
+import mmap
+from abc import abstractmethod
+from bisect import bisect_left
+from collections import Mapping
+from struct import pack, unpack_from
+from numpy import arange, array, concatenate, cumsum, flatnonzero, frombuffer, int32, int64, uint8, searchsorted, \
+	where, zeros
+
+file_magic = "NCBITAXC"
+file_version = 2
+no_parent = -1
+no_rank = 255
+
+
+def _offsets(strings):
+	"""
+		Start offsets of concatenated strings, followed by the total length
+
+		@type strings: list[str]
+
+		@rtype: numpy.ndarray
+	"""
+	return concatenate((zeros(1, dtype=int64), cumsum([len(string) for string in strings], dtype=int64)))
+
+
+def taxonomy_arrays(taxid_to_parent_taxid, taxid_to_rank, size=None):
+	"""
+		Parent taxids and rank codes in arrays indexed by taxid
+
+		@param taxid_to_parent_taxid: parent of each node
+		@type taxid_to_parent_taxid: dict[str, str]
+		@param taxid_to_rank: rank of each node
+		@type taxid_to_rank: dict[str, str]
+		@param size: array length, by default one more than the largest taxid
+		@type size: None | int
+
+		@return: int32 parents (no_parent for unused taxids), uint8 rank codes (no_rank) and the rank of each code
+		@rtype: (numpy.ndarray, numpy.ndarray, list[str])
+	"""
+	if size is None:
+		size = 1 + max(int(taxid) for taxid in taxid_to_parent_taxid)
+	assert size < 2**31
+
+	parents = zeros(size, dtype=int32)
+	parents.fill(no_parent)
+	items = taxid_to_parent_taxid.items()
+	parents[[int(taxid) for taxid, parent in items]] = [int(parent) for taxid, parent in items]
+
+	rank_names = sorted(set(taxid_to_rank.itervalues()))
+	assert len(rank_names) < no_rank
+	rank_codes = dict((rank, code) for code, rank in enumerate(rank_names))
+	ranks = zeros(size, dtype=uint8)
+	ranks.fill(no_rank)
+	items = taxid_to_rank.items()
+	ranks[[int(taxid) for taxid, rank in items]] = [rank_codes[rank] for taxid, rank in items]
+	return parents, ranks, rank_names
+
+
+def ancestors_at_ranks(parents, ranks, rank_names, lineage_ranks):
+	"""
+		Table of the ancestors of each node at given ranks, including the node itself, and 0 if there is none.
+
+		If a rank occurs several times in a lineage, the node closest to the root is used like in
+		NcbiTaxonomy.get_lineage_of_legal_ranks. The table is built by pointer doubling, each step merges the rows
+		of the ancestors twice as far up, so the number of steps is logarithmic in the depth of the taxonomy.
+
+		@param parents: parent taxid of each taxid
+		@type parents: numpy.ndarray
+		@param ranks: rank code of each taxid
+		@type ranks: numpy.ndarray
+		@param rank_names: rank of each rank code
+		@type rank_names: list[str]
+		@param lineage_ranks: ranks of the table columns
+		@type lineage_ranks: list[str]
+
+		@return: int32 array of shape (number of taxids, number of ranks)
+		@rtype: numpy.ndarray
+	"""
+	nodes = arange(len(parents), dtype=int32)
+	table = zeros((len(parents), len(lineage_ranks)), dtype=int32)
+	for column, rank in enumerate(lineage_ranks):
+		if rank in rank_names:
+			selection = ranks == rank_names.index(rank)
+			table[selection, column] = nodes[selection]
+
+	# rows cover the lineage from a node up to (exclusive) its ancestor, the upper part takes precedence
+	ancestors = where(parents == no_parent, nodes, parents)
+	while True:
+		upper = table[ancestors]
+		table = where(upper != 0, upper, table)
+		next_ancestors = ancestors[ancestors]
+		if (next_ancestors == ancestors).all():
+			return table
+		ancestors = next_ancestors
+
+
+def write_compiled_taxonomy(file_path, taxid_to_parent_taxid, taxid_to_rank, taxid_to_name, taxid_old_to_taxid_new,
+		name_to_taxids, lineage_ranks):
+	"""
+		Write the taxonomy dictionaries of NcbiTaxonomy into a compiled taxonomy file.
+
+		The file is written under a temporary name and moved into place, so concurrent readers never see a partial file.
+
+		@param file_path: compiled taxonomy file
+		@type file_path: str | unicode
+		@param taxid_to_parent_taxid: parent of each node
+		@type taxid_to_parent_taxid: dict[str, str]
+		@param taxid_to_rank: rank of each node
+		@type taxid_to_rank: dict[str, str]
+		@param taxid_to_name: scientific name of each node
+		@type taxid_to_name: dict[str, str]
+		@param taxid_old_to_taxid_new: merged ids
+		@type taxid_old_to_taxid_new: dict[str, str]
+		@param name_to_taxids: lowercased names and synonyms
+		@type name_to_taxids: dict[str, set[str]]
+		@param lineage_ranks: ranks of the ancestor table
+		@type lineage_ranks: list[str]
+
+		@rtype: None
+	"""
+	size = 1 + max(max(int(taxid) for taxid in taxid_to_parent_taxid), max(int(taxid) for taxid in taxid_to_name))
+	parents, ranks, rank_names = taxonomy_arrays(taxid_to_parent_taxid, taxid_to_rank, size)
+
+	names = [""] * size
+	for taxid, name in taxid_to_name.iteritems():
+		names[int(taxid)] = name
+
+	items = sorted((int(old), int(new)) for old, new in taxid_old_to_taxid_new.iteritems())
+	merged = array(items, dtype=int32).reshape(len(items), 2)
+
+	keys = sorted(name_to_taxids)
+	groups = [sorted(int(taxid) for taxid in name_to_taxids[key]) for key in keys]
+	group_offsets = _offsets(groups)
+	key_taxids = array([taxid for group in groups for taxid in group], dtype=int32)
+
+	lineage = ancestors_at_ranks(parents, ranks, rank_names, lineage_ranks)
+
+	sections = [
+		("parent", parents.tostring()),
+		("rank", ranks.tostring()),
+		("ranks", "\n".join(rank_names)),
+		("nameoff", _offsets(names).tostring()),
+		("names", "".join(names)),
+		("mergeold", merged[:, 0].tostring()),
+		("mergenew", merged[:, 1].tostring()),
+		("keyoff", _offsets(keys).tostring()),
+		("keys", "".join(keys)),
+		("keygrp", group_offsets.tostring()),
+		("keytaxid", key_taxids.tostring()),
+		("linranks", "\n".join(lineage_ranks)),
+		("lineage", lineage.tostring()),
+		]
+
+	# header: magic, version, number of sections and a table of (name, offset, size), sections aligned to 8 bytes
+	header_size = len(file_magic) + 8 + 24 * len(sections)
+	table = []
+	offset = header_size
+	for name, data in sections:
+		offset += -offset % 8
+		table.append(pack("<8sQQ", name, offset, len(data)))
+		offset += len(data)
+
+	tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+	try:
+		with open(tmp_path, "wb") as stream:
+			stream.write(file_magic + pack("<II", file_version, len(sections)) + "".join(table))
+			for name, data in sections:
+				stream.write("\0" * (-stream.tell() % 8))
+				stream.write(data)
+		os.rename(tmp_path, file_path)  # atomic, other readers see a complete file or none
+	except:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+
+class CompiledTaxonomy(object):
+	"""Memory-mapped compiled taxonomy with read-only dictionary views like the ones of NcbiTaxonomy"""
+
+	def __init__(self, file_path):
+		"""
+			Open a compiled taxonomy file
+
+			@param file_path: compiled taxonomy file
+			@type file_path: str | unicode
+
+			@raise ValueError: if the file is not a compiled taxonomy
+		"""
+		with open(file_path, "rb") as stream:
+			self._buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+		buf = self._buffer
+		if buf[:len(file_magic)] != file_magic:
+			raise ValueError("Not a compiled taxonomy file: '{}'".format(file_path))
+		version, num_sections = unpack_from("<II", buf, len(file_magic))
+		if version != file_version:
+			raise ValueError("Unsupported compiled taxonomy version {}: '{}'".format(version, file_path))
+		self._sections = {}
+		for index in xrange(num_sections):
+			name, offset, size = unpack_from("<8sQQ", buf, len(file_magic) + 8 + 24 * index)
+			self._sections[name.rstrip("\0")] = offset, size
+
+		self.parents = self._array("parent", int32)
+		self.ranks = self._array("rank", uint8)
+		self.rank_names = self._string("ranks").split("\n")
+		self.names = _Strings(buf, self._array("nameoff", int64), self._sections["names"][0])
+		self.merged_old = self._array("mergeold", int32)
+		self.merged_new = self._array("mergenew", int32)
+		self.keys = _Strings(buf, self._array("keyoff", int64), self._sections["keys"][0])
+		self.key_groups = self._array("keygrp", int64)
+		self.key_taxids = self._array("keytaxid", int32)
+		self.lineage_ranks = self._string("linranks").split("\n")
+		self.lineage = self._array("lineage", int32).reshape(len(self.parents), len(self.lineage_ranks))
+		self._lineage_columns = {}
+
+		self.taxid_to_parent_taxid = ParentMapping(self)
+		self.taxid_to_rank = RankMapping(self)
+		self.taxid_to_name = NameMapping(self)
+		self.taxid_old_to_taxid_new = MergedMapping(self)
+		self.name_to_taxids = NameIndexMapping(self)
+
+	def lineage_columns(self, ranks):
+		"""
+			Columns of the ancestor table for a list of ranks
+
+			@param ranks: List of ncbi ranks in lower case
+			@type ranks: list[basestring]
+
+			@return: list of columns or None if a rank is not in the table
+			@rtype: list[int] | None
+		"""
+		ranks = tuple(ranks)
+		if ranks not in self._lineage_columns:
+			if all(rank in self.lineage_ranks for rank in ranks):
+				self._lineage_columns[ranks] = [self.lineage_ranks.index(rank) for rank in ranks]
+			else:
+				self._lineage_columns[ranks] = None
+		return self._lineage_columns[ranks]
+
+	def _array(self, name, dtype):
+		offset, size = self._sections[name]
+		return frombuffer(self._buffer, dtype=dtype, count=size // dtype().itemsize, offset=offset)
+
+	def _string(self, name):
+		offset, size = self._sections[name]
+		return self._buffer[offset:offset + size]
+
+
+class _Strings(object):
+	"""Sequence of the strings in an offset-indexed blob"""
+
+	def __init__(self, buf, offsets, base):
+		self._buffer = buf
+		self._offsets = offsets
+		self._base = base
+
+	def __len__(self):
+		return len(self._offsets) - 1
+
+	def __getitem__(self, index):
+		start, end = self._offsets[index:index + 2].tolist()
+		return self._buffer[self._base + start:self._base + end]
+
+	def lengths(self):
+		return self._offsets[1:] - self._offsets[:-1]
+
+
+class _TaxidMapping(Mapping):
+	"""
+	Read-only dictionary view on a compiled taxonomy with taxids given as strings like in the dump files, the
+	subclasses define the valid taxids (Mapping is an abstract base class, so _valid must be implemented)
+	"""
+
+	def __init__(self, compiled):
+		self._compiled = compiled
+		self._taxids = None
+
+	def _index(self, taxid):
+		"""array index of a taxid or None"""
+		try:
+			index = int(taxid)
+		except (TypeError, ValueError):
+			return None
+		if str(index) != taxid or not 0 <= index < len(self._compiled.parents):
+			return None
+		return index
+
+	@abstractmethod
+	def _valid(self):
+		"""boolean array of the defined taxids"""
+
+	def __iter__(self):
+		if self._taxids is None:
+			self._taxids = flatnonzero(self._valid())
+		return (str(index) for index in self._taxids.tolist())
+
+	def __len__(self):
+		if self._taxids is None:
+			self._taxids = flatnonzero(self._valid())
+		return len(self._taxids)
+
+
+class ParentMapping(_TaxidMapping):
+	"""taxid -> parent taxid"""
+
+	def _valid(self):
+		return self._compiled.parents != no_parent
+
+	def __getitem__(self, taxid):
+		index = self._index(taxid)
+		if index is None or self._compiled.parents[index] == no_parent:
+			raise KeyError(taxid)
+		return str(self._compiled.parents[index])
+
+	def __contains__(self, taxid):
+		index = self._index(taxid)
+		return index is not None and self._compiled.parents[index] != no_parent
+
+
+class RankMapping(_TaxidMapping):
+	"""taxid -> rank"""
+
+	def _valid(self):
+		return self._compiled.ranks != no_rank
+
+	def __getitem__(self, taxid):
+		index = self._index(taxid)
+		if index is None or self._compiled.ranks[index] == no_rank:
+			raise KeyError(taxid)
+		return self._compiled.rank_names[self._compiled.ranks[index]]
+
+	def __contains__(self, taxid):
+		index = self._index(taxid)
+		return index is not None and self._compiled.ranks[index] != no_rank
+
+
+class NameMapping(_TaxidMapping):
+	"""taxid -> scientific name"""
+
+	def _valid(self):
+		return self._compiled.names.lengths() > 0
+
+	def __getitem__(self, taxid):
+		index = self._index(taxid)
+		name = self._compiled.names[index] if index is not None else ""
+		if not name:
+			raise KeyError(taxid)
+		return name
+
+	def __contains__(self, taxid):
+		index = self._index(taxid)
+		return index is not None and bool(self._compiled.names[index])
+
+
+class MergedMapping(Mapping):
+	"""old taxid -> new taxid of merged nodes"""
+
+	def __init__(self, compiled):
+		self._compiled = compiled
+
+	def _position(self, taxid):
+		"""position of an old taxid in the sorted array or None"""
+		try:
+			index = int(taxid)
+		except (TypeError, ValueError):
+			return None
+		old = self._compiled.merged_old
+		if str(index) != taxid or not 0 <= index < 2**31:
+			return None
+		position = int(searchsorted(old, index))
+		if position == len(old) or old[position] != index:
+			return None
+		return position
+
+	def __getitem__(self, taxid):
+		position = self._position(taxid)
+		if position is None:
+			raise KeyError(taxid)
+		return str(self._compiled.merged_new[position])
+
+	def __contains__(self, taxid):
+		return self._position(taxid) is not None
+
+	def __iter__(self):
+		return (str(taxid) for taxid in self._compiled.merged_old.tolist())
+
+	def __len__(self):
+		return len(self._compiled.merged_old)
+
+
+class NameIndexMapping(Mapping):
+	"""lowercased name or synonym -> set of taxids"""
+
+	def __init__(self, compiled):
+		self._compiled = compiled
+
+	def _position(self, name):
+		"""position of a name in the sorted keys or None"""
+		if not isinstance(name, basestring):
+			return None
+		keys = self._compiled.keys
+		position = bisect_left(keys, name)
+		if position == len(keys) or keys[position] != name:
+			return None
+		return position
+
+	def taxids(self, position):
+		"""
+			Taxids of the name at a position of the sorted keys
+
+			@type position: int
+
+			@rtype: set[str]
+		"""
+		start, end = self._compiled.key_groups[position:position + 2].tolist()
+		return set(str(taxid) for taxid in self._compiled.key_taxids[start:end].tolist())
+
+	def __getitem__(self, name):
+		position = self._position(name)
+		if position is None:
+			raise KeyError(name)
+		return self.taxids(position)
+
+	def __contains__(self, name):
+		return self._position(name) is not None
+
+	def __iter__(self):
+		keys = self._compiled.keys
+		return (keys[position] for position in xrange(len(keys)))
+
+	def __len__(self):
+		return len(self._compiled.keys)
@@ -0,0 +1,194 @@
+"""
+Parsing of the NCBI taxonomy dump files in byte ranges by a process pool.
+
+A dump file is split at line boundaries into byte ranges, each range is parsed into partial dictionaries by a worker
+and the partial results are merged in file order by the calling process.
+"""
+
+import os
+import gc
+from multiprocessing import Pool, cpu_count
+
+chunk_size = 2**24
+
+
+def byte_ranges(file_path, size=chunk_size):
+	"""
+		Split a file at line boundaries into byte ranges of about the given size
+
+		@param file_path: file path
+		@type file_path: str | unicode
+		@param size: minimum number of bytes of a range, except for the last one
+		@type size: int
+
+		@return: start and end offset of each range
+		@rtype: list[(int, int)]
+	"""
+	file_size = os.path.getsize(file_path)
+	ranges = []
+	start = 0
+	with open(file_path, "rb") as file_handler:
+		while start < file_size:
+			file_handler.seek(min(start + size, file_size))
+			file_handler.readline()
+			end = min(file_handler.tell(), file_size)
+			ranges.append((start, end))
+			start = end
+	return ranges
+
+
+def _read_lines(file_path, start, end):
+	"""lines of a byte range of a file."""
+	with open(file_path, "rb") as file_handler:
+		file_handler.seek(start)
+		return file_handler.read(end - start).splitlines()
+
+
+def parse_nodes(task):
+	"""
+		Parse a byte range of nodes.dmp
+
+		@param task: file path, start and end offset
+		@type task: (str, int, int)
+
+		@return: taxid -> parent taxid, taxid -> rank
+		@rtype: (dict[str, str], dict[str, str])
+	"""
+	return parse_nodes_lines(_read_lines(*task))
+
+
+def parse_nodes_lines(lines):
+	"""
+		Parse lines of nodes.dmp
+
+		@type lines: collections.Iterable[str]
+
+		@return: taxid -> parent taxid, taxid -> rank
+		@rtype: (dict[str, str], dict[str, str])
+	"""
+	taxid_to_parent_taxid = {}
+	taxid_to_rank = {}
+	for line in lines:
+		elements = [el.strip() for el in line.split('|')]
+		taxid, parent_taxid, rank = elements[0:3]
+		taxid_to_parent_taxid[taxid] = parent_taxid
+		taxid_to_rank[taxid] = rank.lower()  # should be lower-case in file, but can't be bad to doublecheck
+	return taxid_to_parent_taxid, taxid_to_rank
+
+
+def parse_names(task):
+	"""
+		Parse a byte range of names.dmp
+
+		@param task: file path, start and end offset and if the name index, the scientific names and the rows to build
+			the node tree are needed
+		@type task: (str, int, int, bool, bool, bool)
+
+		@return: see parse_names_lines
+		@rtype: (dict[str, set[str]], dict[str, str], list[(str, str, str, str)])
+	"""
+	file_path, start, end, with_name_index, with_scientific_names, with_rows = task
+	return parse_names_lines(_read_lines(file_path, start, end), with_name_index, with_scientific_names, with_rows)
+
+
+def parse_names_lines(lines, with_name_index=True, with_scientific_names=True, with_rows=False):
+	"""
+		Parse lines of names.dmp
+
+		@type lines: collections.Iterable[str]
+		@param with_name_index: build the name index
+		@type with_name_index: bool
+		@param with_scientific_names: collect the scientific names
+		@type with_scientific_names: bool
+		@param with_rows: collect the rows to build the node tree
+		@type with_rows: bool
+
+		@return: lowercased name -> taxids, taxid -> scientific name and (taxid, name, unique name, name class) of
+			each line, each one empty if not requested
+		@rtype: (dict[str, set[str]], dict[str, str], list[(str, str, str, str)])
+	"""
+	name_to_taxids = {}
+	taxid_to_name = {}
+	rows = []
+	for line in lines:
+		# 65      |       Herpetosiphon aurantiacus       |               |       scientific name |
+		taxid, name, unique, name_class, sonst = [el.strip() for el in line.split('|')]
+		assert int(taxid)
+		if with_name_index:
+			name_to_taxids.setdefault(name.lower(), set()).add(taxid)
+		if with_scientific_names and name_class == 'scientific name':
+			taxid_to_name[taxid] = name
+		if with_rows:
+			rows.append((taxid, name, unique, name_class))
+	return name_to_taxids, taxid_to_name, rows
+
+
+def parse_merged(task):
+	"""
+		Parse a byte range of merged.dmp
+
+		@param task: file path, start and end offset
+		@type task: (str, int, int)
+
+		@return: old taxid -> new taxid
+		@rtype: dict[str, str]
+	"""
+	return parse_merged_lines(_read_lines(*task))
+
+
+def parse_merged_lines(lines):
+	"""
+		Parse lines of merged.dmp
+
+		@type lines: collections.Iterable[str]
+
+		@return: old taxid -> new taxid
+		@rtype: dict[str, str]
+	"""
+	taxid_old_to_taxid_new = {}
+	for line in lines:
+		# 5085       |       746128  |
+		old_taxid, new_taxid, sonst = line.strip().split('|')
+		taxid_old_to_taxid_new[old_taxid.strip()] = new_taxid.strip()
+	return taxid_old_to_taxid_new
+
+
+def parse_dump_file(file_path, parser, arguments=(), jobs=None):
+	"""
+		Parse a dump file in byte ranges, by a process pool if there is more than one range
+
+		@param file_path: file path
+		@type file_path: str | unicode
+		@param parser: parse_nodes, parse_names or parse_merged
+		@type parser: callable
+		@param arguments: additional task arguments for the parser
+		@type arguments: tuple
+		@param jobs: maximum number of worker processes, by default the number of CPUs
+		@type jobs: None | int
+
+		@return: partial results in file order
+		@rtype: collections.Iterable
+	"""
+	tasks = [(file_path, start, end) + arguments for start, end in byte_ranges(file_path)]
+	if jobs is None:
+		jobs = cpu_count()
+	jobs = min(jobs, len(tasks))
+	# the results are millions of strings and sets without reference cycles, which would trigger many collections
+	gc_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		if jobs <= 1:
+			for task in tasks:
+				yield parser(task)
+			return
+		pool = Pool(jobs)
+		try:
+			for result in pool.imap(parser, tasks):
+				yield result
+			pool.close()
+		finally:
+			pool.terminate()
+			pool.join()
+	finally:
+		if gc_enabled:
+			gc.enable()
@@ -0,0 +1,30 @@
+from collections import Mapping
+
+
+class LazyMapping(Mapping):
+	"""Read-only placeholder of a dictionary which is loaded on first access"""
+
+	def __init__(self, load):
+		"""
+			@param load: function without arguments which loads and returns the dictionary
+			@type load: callable
+		"""
+		self._load = load
+		self._mapping = None
+
+	def _loaded(self):
+		if self._mapping is None:
+			self._mapping = self._load()
+		return self._mapping
+
+	def __getitem__(self, key):
+		return self._loaded()[key]
+
+	def __contains__(self, key):
+		return key in self._loaded()
+
+	def __iter__(self):
+		return iter(self._loaded())
+
+	def __len__(self):
+		return len(self._loaded())
@@ -0,0 +1,92 @@
+"""
+Lowest common ancestor queries on the NCBI taxonomy by binary lifting.
+"""
+
+from numpy import arange, asarray, int32, where
+from compiledtaxonomy import no_parent
+
+
+class LcaIndex(object):
+	"""Binary lifting table of the 2**k-th ancestors of each taxid and the depth of each taxid"""
+
+	def __init__(self, parents, root=1):
+		"""
+			Build the index by pointer doubling on the parent array
+
+			@param parents: parent taxid of each taxid, negative for unused taxids, the root is its own parent
+			@type parents: numpy.ndarray
+			@param root: taxid of the root node
+			@type root: int
+		"""
+		nodes = arange(len(parents), dtype=int32)
+		self.valid = parents != no_parent
+		ancestors = where(self.valid, parents, nodes).astype(int32)
+		ancestors[root] = root
+		# distance to the 2**k-th ancestor, which is the depth once all ancestors are the root
+		depths = (ancestors != nodes).astype(int32)
+		self.ancestors = [ancestors]
+		# nodes in a cycle which does not reach the root are cut off after log2(size) steps
+		for _ in range(len(parents).bit_length()):
+			next_ancestors = ancestors[ancestors]
+			if (next_ancestors == ancestors).all():
+				break
+			depths += depths[ancestors]
+			ancestors = next_ancestors
+			self.ancestors.append(ancestors)
+		self.depths = depths
+
+	def _check(self, taxids):
+		taxids = asarray(taxids, dtype=int32)
+		if not ((0 <= taxids) & (taxids < len(self.valid))).all() or not self.valid[taxids].all():
+			raise ValueError("Invalid taxid")
+		return taxids
+
+	def lowest_common_ancestors(self, taxids_a, taxids_b):
+		"""
+			Lowest common ancestor of each pair of taxids
+
+			@param taxids_a: taxids as integers
+			@type taxids_a: numpy.ndarray | list[int]
+			@param taxids_b: taxids as integers, same length as taxids_a
+			@type taxids_b: numpy.ndarray | list[int]
+
+			@raise ValueError: if a taxid is not in the taxonomy
+			@rtype: numpy.ndarray
+		"""
+		a = self._check(taxids_a)
+		b = self._check(taxids_b)
+		assert a.shape == b.shape
+		# lift the deeper taxid of each pair to the depth of the other
+		swap = self.depths[a] < self.depths[b]
+		a, b = where(swap, b, a), where(swap, a, b)
+		difference = self.depths[a] - self.depths[b]
+		for k, ancestors in enumerate(self.ancestors):
+			a = where((difference >> k) & 1 == 1, ancestors[a], a)
+		# lift both to just below the common ancestor
+		for ancestors in reversed(self.ancestors):
+			upper_a = ancestors[a]
+			upper_b = ancestors[b]
+			different = upper_a != upper_b
+			a = where(different, upper_a, a)
+			b = where(different, upper_b, b)
+		return where(a == b, a, self.ancestors[0][a])
+
+	def distances(self, taxids_a, taxids_b, lowest_common_ancestors=None):
+		"""
+			Number of edges on the path between each pair of taxids
+
+			@param taxids_a: taxids as integers
+			@type taxids_a: numpy.ndarray | list[int]
+			@param taxids_b: taxids as integers, same length as taxids_a
+			@type taxids_b: numpy.ndarray | list[int]
+			@param lowest_common_ancestors: result of lowest_common_ancestors, if already known
+			@type lowest_common_ancestors: None | numpy.ndarray
+
+			@raise ValueError: if a taxid is not in the taxonomy
+			@rtype: numpy.ndarray
+		"""
+		a = self._check(taxids_a)
+		b = self._check(taxids_b)
+		if lowest_common_ancestors is None:
+			lowest_common_ancestors = self.lowest_common_ancestors(a, b)
+		return self.depths[a] + self.depths[b] - 2 * self.depths[lowest_common_ancestors]
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+
+
+class LruCache(object):
+	"""Size-bounded cache which drops the least recently used entries, counting hits and misses"""
+
+	def __init__(self, max_size=2**16):
+		"""
+			@param max_size: maximum number of entries
+			@type max_size: int
+		"""
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+
+	def get(self, key):
+		"""
+			Return a cached value and mark it as recently used
+
+			@param key: hashable key
+
+			@return: value or None if the key is not cached
+		"""
+		value = self._entries.pop(key, None)
+		if value is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self._entries[key] = value
+		return value
+
+	def put(self, key, value):
+		"""
+			Cache a value which must not be None
+
+			@param key: hashable key
+			@param value: value
+
+			@rtype: None
+		"""
+		assert value is not None
+		self._entries[key] = value
+		while len(self._entries) > self.max_size:
+			self._entries.popitem(last=False)
+
+	def clear(self):
+		"""
+			Drop all entries and reset the counters
+
+			@rtype: None
+		"""
+		self._entries.clear()
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self._entries)
@@ -0,0 +1,226 @@
+"""
+Index of the lowercased names of the NCBI taxonomy for shell-style pattern queries (fnmatch).
+
+The literal prefix of a pattern selects a range of the sorted names by bisection. Literal parts after the first
+wildcard are looked up in a trigram index, which lists the names containing each occurring trigram in compressed sparse
+rows. The candidates are matched with the regular expression of fnmatch; if there are too many, the range is searched
+with one regular expression over all names joined by newlines. The joined names are built on first use, the trigrams
+only after a few queries, since building them takes longer than a search of the joined names.
+"""
+
+import re
+from bisect import bisect_left
+from fnmatch import translate
+from numpy import arange, bincount, concatenate, cumsum, empty, frombuffer, int64, repeat, searchsorted, uint8, \
+	uint32, uint64, unique, zeros
+
+
+def _literal_runs(pattern):
+	"""
+		Literal parts of a fnmatch pattern, split at '*', '?' and bracket expressions
+
+		@type pattern: str
+
+		@return: literal parts, the first one is the prefix of the pattern (possibly empty), and a regular expression
+			which matches the pattern within a line
+		@rtype: (list[str], str)
+	"""
+	runs = [""]
+	expression = ""
+	index, length = 0, len(pattern)
+	while index < length:
+		character = pattern[index]
+		index += 1
+		if character == "*":
+			expression += "[^\\n]*"
+		elif character == "?":
+			expression += "[^\\n]"
+		elif character == "[":
+			# same bracket parsing as fnmatch.translate, an unclosed bracket is a literal
+			end = index
+			if end < length and pattern[end] == "!":
+				end += 1
+			if end < length and pattern[end] == "]":
+				end += 1
+			while end < length and pattern[end] != "]":
+				end += 1
+			if end >= length:
+				runs[-1] += character
+				expression += "\\["
+				continue
+			stuff = pattern[index:end].replace("\\", "\\\\")
+			index = end + 1
+			if stuff[0] == "!":
+				# a negated set must not match the newline between two names
+				expression += "(?!\\n)"
+				stuff = "^" + stuff[1:]
+			elif stuff[0] == "^":
+				stuff = "\\" + stuff
+			expression += "[{}]".format(stuff)
+		else:
+			runs[-1] += character
+			expression += re.escape(character)
+			continue
+		runs.append("")
+	return runs, "(?m)^{}$".format(expression)
+
+
+def _prefix_end(prefix):
+	"""smallest string which is greater than all strings starting with prefix, None if there is none."""
+	prefix = prefix.rstrip("\xff")
+	if not prefix:
+		return None
+	return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _trigram_codes(data):
+	"""
+		Codes of the trigrams of a byte array
+
+		@type data: numpy.ndarray
+
+		@rtype: numpy.ndarray
+	"""
+	data = data.astype(uint32)
+	return (data[:-2] << 16) | (data[1:-1] << 8) | data[2:]
+
+
+class NameIndex(object):
+	"""Sorted names with a trigram index for fnmatch pattern queries"""
+
+	# ranges up to this size are matched name by name
+	scan_size = 2**10
+	block_size = 2**18
+	# queries with a trigram searched in the joined names before the trigrams are built
+	trigram_queries = 2
+
+	def __init__(self, names):
+		"""
+			@param names: sorted names without newlines
+			@type names: list[str]
+		"""
+		self.names = names
+		self._joined = None
+		self._starts = None
+		self._queries = 0
+		self._codes = None
+		self._offsets = None
+		self._postings = None
+
+	def _build_joined(self):
+		"""
+			Join the names by newlines, with the start offset of each name
+
+			@rtype: None
+		"""
+		names = [self.names[index] for index in xrange(len(self.names))]
+		self._joined = "\n".join(names) + "\n"
+		self._starts = concatenate((zeros(1, dtype=int64), cumsum([len(name) + 1 for name in names], dtype=int64)))
+
+	def _block_trigrams(self, start, stop):
+		"""distinct trigram codes and name indexes of a block of names, sorted by code and name."""
+		begin, end = self._starts[start], self._starts[stop]
+		data = frombuffer(self._joined, dtype=uint8, count=end - begin, offset=begin)
+		codes = _trigram_codes(data)
+		name_indexes = repeat(arange(start, stop, dtype=uint64), self._starts[start + 1:stop + 1] - self._starts[start:stop])
+		within_name = (data[:-2] != 10) & (data[1:-1] != 10) & (data[2:] != 10)
+		keys = unique((codes[within_name].astype(uint64) << 32) | name_indexes[:len(codes)][within_name])
+		return (keys >> 32).astype(uint32), (keys & 0xffffffff).astype(uint32)
+
+	def _build_trigrams(self):
+		"""
+			Build the names of each occurring trigram in compressed sparse rows, by counting sort over blocks of names.
+			The rows are those of the sorted distinct codes, so the size follows the names and not all 2**24 codes.
+
+			@rtype: None
+		"""
+		size = len(self.names)
+		blocks = [(start, min(start + self.block_size, size)) for start in xrange(0, size, self.block_size)]
+		block_codes = []
+		for start, stop in blocks:
+			codes, _ = self._block_trigrams(start, stop)
+			slots, counts = unique(codes, return_counts=True)
+			block_codes.append((slots, counts))
+		codes = unique(concatenate([slots for slots, _ in block_codes]))
+		counts = zeros(len(codes), dtype=int64)
+		for slots, block_counts in block_codes:
+			counts[searchsorted(codes, slots)] += block_counts
+		del block_codes
+		offsets = concatenate((zeros(1, dtype=int64), cumsum(counts)))
+		postings = empty(offsets[-1], dtype=uint32)
+		filled = offsets[:-1].copy()
+		for start, stop in blocks:
+			block_codes, name_indexes = self._block_trigrams(start, stop)
+			slots = searchsorted(codes, block_codes)
+			# entries of a block are sorted by code, the rank of an entry within its code follows the filled ones
+			ranks = arange(len(slots)) - searchsorted(slots, slots)
+			postings[filled[slots] + ranks] = name_indexes
+			filled += bincount(slots, minlength=len(codes))
+		self._codes = codes
+		self._offsets = offsets
+		self._postings = postings
+
+	def _trigram_names(self, runs):
+		"""
+			Indexes of the names containing the rarest trigram of the literal parts, None if there is no trigram or the
+			trigrams are not built yet
+
+			@rtype: numpy.ndarray | None
+		"""
+		runs = [run for run in runs if len(run) >= 3]
+		if not runs:
+			return None
+		if self._postings is None:
+			self._queries += 1
+			if self._queries <= self.trigram_queries:
+				return None
+			self._build_trigrams()
+		codes = concatenate([_trigram_codes(frombuffer(run, dtype=uint8)) for run in runs])
+		slots = searchsorted(self._codes, codes)
+		found = slots < len(self._codes)
+		found[found] = self._codes[slots[found]] == codes[found]
+		if not found.all():
+			# a trigram which no name contains
+			return empty(0, dtype=uint32)
+		counts = self._offsets[slots + 1] - self._offsets[slots]
+		slot = slots[counts.argmin()]
+		return self._postings[self._offsets[slot]:self._offsets[slot + 1]]
+
+	def match(self, pattern):
+		"""
+			Names matching a shell-style pattern, like fnmatch.filter
+
+			@param pattern: pattern with '*', '?' and bracket expressions
+			@type pattern: str
+
+			@return: matching names in sorted order
+			@rtype: list[str]
+		"""
+		if isinstance(pattern, unicode):
+			pattern = pattern.encode("utf-8")
+		runs, line_expression = _literal_runs(pattern)
+		names = self.names
+		start = bisect_left(names, runs[0])
+		if len(runs) == 1:
+			if start < len(names) and names[start] == pattern:
+				return [pattern]
+			return []
+		end = _prefix_end(runs[0])
+		stop = len(names) if end is None else bisect_left(names, end, start)
+		expression = re.compile(translate(pattern))
+		if stop - start <= self.scan_size or "\n" in pattern:
+			return [name for name in (names[index] for index in xrange(start, stop)) if expression.match(name)]
+
+		if self._joined is None:
+			self._build_joined()
+		joined, starts = self._joined, self._starts
+		candidates = self._trigram_names(runs[1:])
+		if candidates is not None:
+			lower, upper = searchsorted(candidates, [start, stop])
+			# a candidate is matched on its own, which is worth it for a small part of the range
+			if (upper - lower) * 8 < stop - start:
+				return [
+					joined[starts[index]:starts[index + 1] - 1] for index in candidates[lower:upper].tolist()
+					if expression.match(joined, starts[index], starts[index + 1] - 1)]
+		# the range ends before the newline of its last name, so there is no empty line at the end
+		return re.compile(line_expression).findall(joined, starts[start], starts[stop] - 1)
@@ -6,10 +6,34 @@ __version__ = '0.1.3'
 
 import os
 import time
-import fnmatch
+import tempfile
+from functools import partial, wraps
+from numpy import array, empty, int32
 from taxonomynode import TaxonomyNode
+from compiledtaxonomy import CompiledTaxonomy, taxonomy_arrays, write_compiled_taxonomy
+from lazymapping import LazyMapping
+from dumpparser import parse_dump_file, parse_merged, parse_names, parse_nodes
+from lcaindex import LcaIndex
+from nameindex import NameIndex
+from taxonomystore import TaxonomyStore, taxonomy_fingerprint
+from taxonomyserver import TaxonomyClient
 from scripts.Validator.validator import Validator
 
+# names of the methods answered by a taxonomy server
+served_methods = set()
+
+
+def served(method):
+	"""decorate a lookup method, which a taxonomy server answers if the object is connected to one."""
+	served_methods.add(method.__name__)
+
+	@wraps(method)
+	def lookup(self, *args, **kwargs):
+		if self._client is not None:
+			return self._client.call(self.fingerprint, method.__name__, args, kwargs)
+		return method(self, *args, **kwargs)
+	return lookup
+
 
 class NcbiTaxonomy(Validator):
 	"""Loading NCBI from SQL dump into dictionary for fast processing"""
@@ -19,18 +43,42 @@ class NcbiTaxonomy(Validator):
 	_label = "NcbiTaxonomy"
 
 	default_ordered_legal_ranks = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species', 'strain']
-	name_to_taxids = {}
-	taxid_to_parent_taxid = {}
-	taxid_to_name = {}
-	taxid_to_rank = {}
-	taxid_old_to_taxid_new = {}
-	_has_node_tree = False
-
-	def __init__(self, taxonomy_directory="./", build_node_tree=False, verbose=True, logfile=None):
+	# taxids whose lineage of legal ranks is the one of another taxid
+	lineage_substitutes = {"45202": "36549"}
+	# components of the taxonomy and their dictionaries
+	components = ("structure", "scientific_names", "name_index", "merged")
+	_component_attributes = {
+		"structure": ("taxid_to_parent_taxid", "taxid_to_rank"),
+		"scientific_names": ("taxid_to_name", ),
+		"name_index": ("name_to_taxids", ),
+		"merged": ("taxid_old_to_taxid_new", )}
+	# registry of the loaded taxonomy versions: fingerprint -> TaxonomyStore
+	_stores = {}
+	# environment variable with the socket path of a taxonomy server
+	socket_variable = "NCBI_TAXONOMY_SOCKET"
+
+	def __init__(
+		self, taxonomy_directory="./", build_node_tree=False, verbose=True, logfile=None, cache_file=None, jobs=None,
+		components=None, fingerprint=None, socket_path=None):
 		"""
 			Loading NCBI from SQL dump files into dictionary.
 
-			@attention: building a node tree requires several gigabytes of RAM !!!
+			The taxonomy is registered by its fingerprint, objects of the same taxonomy version share the loaded
+			dictionaries and objects of different versions can be used side by side.
+
+			If a taxonomy server (taxserver) listens on the socket, the lookups are answered by the server, which loads
+			each taxonomy version once. The dictionaries and the lowest common ancestor index are loaded in this
+			process on first access. Without a server, the taxonomy is loaded in this process.
+
+			If a cache file is given, the taxonomy is opened from this compiled taxonomy file (memory-mapped) instead
+			of parsing the dump files. A missing cache file is written after parsing the dump files. The cache file
+			must be specific for the version of the dump files, e.g. by using a hash of the files in the name.
+
+			Without a compiled taxonomy, only the given components are read from the dump files at once, the others
+			are read on first access: 'structure' (parents and ranks), 'scientific_names', 'name_index' (lowercased
+			names and synonyms to taxids) and 'merged' (merged taxids).
+
+			@attention: building a node tree requires the names of all nodes in memory
 
 			@param taxonomy_directory: directory containing ncbi dump
 			@type taxonomy_directory: str | unicode
@@ -40,6 +88,18 @@ class NcbiTaxonomy(Validator):
 			@type verbose: bool
 			@param logfile: file stream or file path of logfile
 			@type logfile: None | file | FileIO | StringIO | basestring
+			@param cache_file: file path of compiled taxonomy, not used to build a node tree
+			@type cache_file: None | str | unicode
+			@param jobs: number of processes parsing the dump files, by default the number of CPUs
+			@type jobs: None | int
+			@param components: components read at once, by default all, all are read to build a node tree or cache file
+			@type components: None | list[str]
+			@param fingerprint: fingerprint of the taxonomy version, by default from the sizes and modification times of
+				the dump files
+			@type fingerprint: None | str
+			@param socket_path: socket of a taxonomy server, by default the environment variable NCBI_TAXONOMY_SOCKET,
+				an empty path to load the taxonomy in this process, not used to build a node tree
+			@type socket_path: None | str | unicode
 
 			@return: None
 			@rtype: None
@@ -51,23 +111,146 @@ class NcbiTaxonomy(Validator):
 		self._file_path_ncbi_names = os.path.join(taxonomy_directory, "names.dmp")
 		self._file_path_ncbi_merged = os.path.join(taxonomy_directory, "merged.dmp")
 		self._file_path_ncbi_nodes = os.path.join(taxonomy_directory, "nodes.dmp")
+		self._jobs = jobs
 		# self._gi_taxid_file = os.path.join(taxonomy_directory, "gi_taxid_nucl.dmp")
+		if fingerprint is None:
+			fingerprint = taxonomy_fingerprint(taxonomy_directory)
+		self.fingerprint = fingerprint
+		self._store = None
+		self._load_arguments = (build_node_tree, cache_file, components)
+
+		if socket_path is None:
+			socket_path = os.environ.get(NcbiTaxonomy.socket_variable)
+		self._client = None
+		if socket_path and not build_node_tree:
+			self._client = self._connect(socket_path, taxonomy_directory, cache_file)
+		if self._client is None:
+			self._load(*self._load_arguments)
+
+	def _connect(self, socket_path, taxonomy_directory, cache_file):
+		"""connection to the taxonomy server which opened this taxonomy, None if there is none."""
+		client = TaxonomyClient.connect(socket_path)
+		if client is None:
+			self._logger.info("No taxonomy server listening on:\t'{}'".format(socket_path))
+			return None
+		# the server resolves relative paths in its own working directory
+		if cache_file is not None:
+			cache_file = self.get_full_path(cache_file)
+		try:
+			client.open_taxonomy(taxonomy_directory, cache_file, self.fingerprint)
+		except Exception as e:
+			self._logger.warning("Taxonomy server could not open taxonomy: {}".format(e))
+			client.close()
+			return None
+		self._logger.info("Using taxonomy server:\t'{}'".format(socket_path))
+		return client
+
+	def _load(self, build_node_tree, cache_file, components):
+		"""load the taxonomy into the store of its version in this process, unless it is loaded already."""
+		if self.fingerprint not in NcbiTaxonomy._stores:
+			NcbiTaxonomy._stores[self.fingerprint] = TaxonomyStore(self.fingerprint)
+		self._store = NcbiTaxonomy._stores[self.fingerprint]
 
 		start = time.time()
 
-		if len(NcbiTaxonomy.taxid_to_name) == 0:
-			NcbiTaxonomy._has_node_tree = build_node_tree
-			self._build_ncbi_taxonomy(build_node_tree)
-			self._read_names_file()
-			self._read_merged_file()
-		elif not NcbiTaxonomy._has_node_tree and build_node_tree:
-			self._build_ncbi_taxonomy(build_node_tree)
+		if not self._store.loaded:
+			self._store.has_node_tree = build_node_tree
+			if cache_file is None or build_node_tree or not self._open_compiled_taxonomy(cache_file):
+				if cache_file is not None:
+					components = None
+				self._read_dump_files(build_node_tree, components)
+				if cache_file is not None and not (build_node_tree and os.path.isfile(cache_file)):
+					self._write_compiled_taxonomy(cache_file)
+		elif not self._store.has_node_tree and build_node_tree:
+			if self._store.compiled is not None or self._has_unread_components():
+				# the node tree is built from all dump files
+				self._read_dump_files(build_node_tree)
+			else:
+				self._build_ncbi_taxonomy(build_node_tree)
 		else:
 			self._logger.info("Using previously loaded Taxonomy")
 
 		end = time.time()
 		self._logger.info("Done ({}s)".format(round(end - start), 1))
 
+	@staticmethod
+	def loaded_fingerprints():
+		"""
+			Return the fingerprints of the registered taxonomy versions
+
+			@rtype: list[str]
+		"""
+		return sorted(NcbiTaxonomy._stores)
+
+	@staticmethod
+	def unload(fingerprint):
+		"""
+			Remove a taxonomy version from the registry, existing objects keep using it
+
+			@param fingerprint: fingerprint of the taxonomy version
+			@type fingerprint: str
+
+			@rtype: None
+		"""
+		NcbiTaxonomy._stores.pop(fingerprint, None)
+
+	def _get_local_store(self):
+		"""store of this process, the taxonomy is loaded on first use if a taxonomy server answers the lookups."""
+		if self._store is None:
+			self._load(*self._load_arguments)
+		return self._store
+
+	@property
+	def name_to_taxids(self):
+		return self._get_local_store().name_to_taxids
+
+	@property
+	def taxid_to_parent_taxid(self):
+		return self._get_local_store().taxid_to_parent_taxid
+
+	@property
+	def taxid_to_name(self):
+		return self._get_local_store().taxid_to_name
+
+	@property
+	def taxid_to_rank(self):
+		return self._get_local_store().taxid_to_rank
+
+	@property
+	def taxid_old_to_taxid_new(self):
+		return self._get_local_store().taxid_old_to_taxid_new
+
+	@property
+	def lookup_cache(self):
+		return self._get_local_store().lookup_cache
+
+	def share(self, directory=None):
+		"""
+			Replace the dictionaries by read-only views on a memory-mapped compiled taxonomy
+
+			Forked processes share the pages of the memory map. The pages of dictionaries are copied by each process
+			over time, since reference counting writes to every object it touches. The compiled taxonomy is written to
+			a temporary file, which is removed once it is mapped. Nothing is done if a compiled taxonomy is used.
+
+			@param directory: directory of the temporary file, by default the one of tempfile
+			@type directory: None | str | unicode
+
+			@rtype: None
+		"""
+		if self._get_local_store().compiled is not None:
+			return
+		for component, attributes in NcbiTaxonomy._component_attributes.iteritems():
+			self._read_component(component, attributes[0])
+		file_descriptor, file_path = tempfile.mkstemp(suffix=".taxc", dir=directory)
+		os.close(file_descriptor)
+		try:
+			self._logger.info("Sharing taxonomy:\t'{}'".format(self.fingerprint))
+			self._write_compiled_taxonomy(file_path, ignore_errors=False)
+			self._open_compiled_taxonomy(file_path)
+		finally:
+			os.remove(file_path)
+
+	@served
 	def get_updated_taxid(self, taxid):
 		"""
 			Return current taxid, in case it was merged
@@ -81,16 +264,17 @@ class NcbiTaxonomy(Validator):
 			@rtype: str | unicode
 		"""
 		assert isinstance(taxid, basestring)
-		if taxid in NcbiTaxonomy.taxid_to_rank:
+		if taxid in self._store.taxid_to_rank:
 			return taxid
-		if taxid not in NcbiTaxonomy.taxid_old_to_taxid_new:
+		if taxid not in self._store.taxid_old_to_taxid_new:
 			self._logger.error("Invalid taxid: '{}'".format(taxid))
 			raise ValueError("Invalid taxid")
 
-		taxid_new = NcbiTaxonomy.taxid_old_to_taxid_new[taxid]
+		taxid_new = self._store.taxid_old_to_taxid_new[taxid]
 		self._logger.warning("Merged id: '{}' -> '{}'".format(taxid, taxid_new))
 		return taxid_new
 
+	@served
 	def get_scientific_name(self, taxid):
 		"""
 			Return scientific name of ncbi taxonomic identifier
@@ -104,12 +288,22 @@ class NcbiTaxonomy(Validator):
 			@rtype: str | unicode
 		"""
 		assert isinstance(taxid, basestring)
+		key = ("scientific_name", taxid)
+		name = self._store.lookup_cache.get(key)
+		if name is None:
+			name = self._get_scientific_name(taxid)
+			self._store.lookup_cache.put(key, name)
+		return name
+
+	def _get_scientific_name(self, taxid):
+		"""uncached get_scientific_name."""
 		taxid = self.get_updated_taxid(taxid)
-		if taxid in NcbiTaxonomy.taxid_to_name:
-			return NcbiTaxonomy.taxid_to_name[taxid]
+		if taxid in self._store.taxid_to_name:
+			return self._store.taxid_to_name[taxid]
 		self._logger.error("No name available for taxid: {}".format(taxid))
 		raise ValueError("Invalid taxid")
 
+	@served
 	def get_taxids_by_scientific_name(self, scientific_name, silent=False):
 		"""
 			Return all available taxid that fit the scientific name
@@ -124,17 +318,30 @@ class NcbiTaxonomy(Validator):
 		"""
 		assert isinstance(scientific_name, basestring)
 		scientific_name = scientific_name.lower()
-		if scientific_name in NcbiTaxonomy.name_to_taxids:
-			return set(NcbiTaxonomy.name_to_taxids[scientific_name])
+		if scientific_name in self._store.name_to_taxids:
+			return set(self._store.name_to_taxids[scientific_name])
 		if not silent:
 			self._logger.error("No taxid available for scientific_name: {}".format(scientific_name))
 			raise ValueError("Invalid scientific name")
 		return None
 
+	def _get_name_index(self):
+		"""index of the sorted names and synonyms, built on first use."""
+		if self._store.name_index is None:
+			if self._store.compiled is not None:
+				names = self._store.compiled.keys
+			else:
+				names = sorted(self._store.name_to_taxids)
+			self._store.name_index = NameIndex(names)
+		return self._store.name_index
+
+	@served
 	def get_taxids_by_scientific_name_wildcard(self, scientific_name):
 		"""
 			Return all available taxid that fit the scientific name
 
+			The shell-style pattern (fnmatch) is looked up in a name index.
+
 			@attention: Several taxid might be a hit for one scientific name
 
 			@param scientific_name: ncbi scientific name or synonym
@@ -145,10 +352,12 @@ class NcbiTaxonomy(Validator):
 		"""
 		assert isinstance(scientific_name, basestring)
 		scientific_name = scientific_name.lower()
-		matches = fnmatch.filter(self.name_to_taxids.keys(), scientific_name)
+		matches = self._get_name_index().match(scientific_name)
 		set_of_tax_id = set()
 		for match in matches:
 			set_of_tax_id.update(set(self.name_to_taxids[match]))
+			if len(set_of_tax_id) > 1:
+				break
 		if len(set_of_tax_id) > 1:
 			self._logger.error(
 				"Several matches '{}' found for scientific_name: '{}'".format(", ".join(matches), scientific_name))
@@ -157,6 +366,7 @@ class NcbiTaxonomy(Validator):
 			return None
 		return set_of_tax_id
 
+	@served
 	def get_lineage_of_legal_ranks(self, taxid, ranks=None, default_value=None, as_name=False, inherit_rank=False):
 		"""
 			Return lineage of a specific taxonomic identifier, filtered by a list of legal ranks
@@ -178,30 +388,34 @@ class NcbiTaxonomy(Validator):
 			@rtype: list[str|unicode|None]
 		"""
 		assert isinstance(taxid, basestring)
-		taxid = self.get_updated_taxid(taxid)
 		if ranks is None:
 			ranks = NcbiTaxonomy.default_ordered_legal_ranks
+		key = ("lineage_of_legal_ranks", taxid, tuple(ranks), as_name, inherit_rank, default_value)
+		lineage = self._store.lookup_cache.get(key)
+		if lineage is None:
+			lineage = tuple(self._get_lineage_of_legal_ranks(taxid, ranks, default_value, as_name, inherit_rank))
+			self._store.lookup_cache.put(key, lineage)
+		return list(lineage)
+
+	def _get_lineage_of_legal_ranks(self, taxid, ranks, default_value, as_name, inherit_rank):
+		"""uncached get_lineage_of_legal_ranks."""
+		taxid = self.get_updated_taxid(taxid)
 
 		lineage = [default_value] * len(ranks)
-		if taxid == "45202":
-			taxid = "36549"
+		taxid = NcbiTaxonomy.lineage_substitutes.get(taxid, taxid)
 		if taxid == "32644":
 			return lineage
-		original_rank = self.get_rank_of_taxid(taxid)
-		if original_rank is not None and original_rank in ranks:
-			if as_name:
-				lineage[ranks.index(original_rank)] = NcbiTaxonomy.taxid_to_name[taxid]
-			else:
-				lineage[ranks.index(original_rank)] = taxid
 
-		while taxid != "1":
-			taxid = NcbiTaxonomy.taxid_to_parent_taxid[taxid]
-			rank = NcbiTaxonomy.taxid_to_rank[taxid]
-			if rank in ranks:
-				if as_name:
-					lineage[ranks.index(rank)] = NcbiTaxonomy.taxid_to_name[taxid]
-				else:
-					lineage[ranks.index(rank)] = taxid
+		compiled = self._store.compiled
+		columns = compiled.lineage_columns(ranks) if compiled is not None else None
+		if columns is not None:
+			# only the first index of a rank is set, like with ranks.index() in the walk
+			for index, taxid_at_rank in enumerate(compiled.lineage[int(taxid), columns].tolist()):
+				if taxid_at_rank and ranks.index(ranks[index]) == index:
+					taxid_at_rank = str(taxid_at_rank)
+					lineage[index] = self._store.taxid_to_name[taxid_at_rank] if as_name else taxid_at_rank
+		else:
+			self._walk_lineage_of_legal_ranks(taxid, ranks, lineage, as_name)
 
 		# todo: sort ranks
 		if inherit_rank:
@@ -219,6 +433,56 @@ class NcbiTaxonomy(Validator):
 					rank_previous = value
 		return lineage
 
+	@served
+	def get_lineages(self, taxids, ranks=None, default_value=None, as_name=False, inherit_rank=False):
+		"""
+			Return lineages of many taxonomic identifiers, filtered by a list of legal ranks
+
+			Each distinct taxid is resolved once with get_lineage_of_legal_ranks.
+
+			@param taxids: ncbi taxonomic identifiers
+			@type taxids: collections.Iterable[basestring]
+			@param ranks: List of ncbi ranks in lower case
+			@type ranks: list[basestring]
+			@param default_value: Value at rank indexes at which the taxid of that specific rank is undefined
+			@type default_value: None | basestring
+			@param as_name: return scientific name if true, not taxonomic id
+			@type as_name: bool
+			@param inherit_rank: name unnamed rank names by known ones, species -> root
+			@type inherit_rank: bool
+
+			@return: object array with one row per taxid and one column per rank
+			@rtype: numpy.ndarray
+		"""
+		if ranks is None:
+			ranks = NcbiTaxonomy.default_ordered_legal_ranks
+		positions = {}
+		inverse = [positions.setdefault(taxid, len(positions)) for taxid in taxids]
+		lineages = empty((len(positions), len(ranks)), dtype=object)
+		for taxid, position in positions.iteritems():
+			lineages[position] = self.get_lineage_of_legal_ranks(
+				taxid, ranks, default_value=default_value, as_name=as_name, inherit_rank=inherit_rank)
+		return lineages[array(inverse, dtype=int)]
+
+	def _walk_lineage_of_legal_ranks(self, taxid, ranks, lineage, as_name):
+		"""fill lineage by walking up to the root."""
+		original_rank = self.get_rank_of_taxid(taxid)
+		if original_rank is not None and original_rank in ranks:
+			if as_name:
+				lineage[ranks.index(original_rank)] = self._store.taxid_to_name[taxid]
+			else:
+				lineage[ranks.index(original_rank)] = taxid
+
+		while taxid != "1":
+			taxid = self._store.taxid_to_parent_taxid[taxid]
+			rank = self._store.taxid_to_rank[taxid]
+			if rank in ranks:
+				if as_name:
+					lineage[ranks.index(rank)] = self._store.taxid_to_name[taxid]
+				else:
+					lineage[ranks.index(rank)] = taxid
+
+	@served
 	def get_lineage(self, taxid):
 		"""
 			Return lineage of a specific taxonomic identifier, filtered by a list of legal ranks
@@ -230,16 +494,27 @@ class NcbiTaxonomy(Validator):
 			@rtype: list[str|unicode]
 		"""
 		assert isinstance(taxid, basestring)
+		key = ("lineage", taxid)
+		lineage = self._store.lookup_cache.get(key)
+		if lineage is None:
+			lineage = tuple(self._get_lineage(taxid))
+			self._store.lookup_cache.put(key, lineage)
+		return list(lineage)
+
+	def _get_lineage(self, taxid):
+		"""uncached get_lineage."""
 		taxid = self.get_updated_taxid(taxid)
-		if NcbiTaxonomy._has_node_tree:
-			return TaxonomyNode.by_name[taxid].get_lineage()
+		if self._store.has_node_tree:
+			tree = self._store.node_tree
+			return [str(taxid) for taxid in tree.taxids[tree.lineage(tree.position(int(taxid)))].tolist()]
 
 		lineage = [taxid]
 		while taxid != "1":
-			taxid = NcbiTaxonomy.taxid_to_parent_taxid[taxid]
+			taxid = self._store.taxid_to_parent_taxid[taxid]
 			lineage.append(taxid)
 		return lineage
 
+	@served
 	def get_parent_taxid_of_legal_ranks(self, taxid, ranks=None):
 		"""
 			Returns taxonomic identifier of the first parent of legal rank and its rank
@@ -253,19 +528,113 @@ class NcbiTaxonomy(Validator):
 			@rtype: tuple
 		"""
 		assert isinstance(taxid, basestring)
-		taxid = self.get_updated_taxid(taxid)
 		if ranks is None:
 			ranks = NcbiTaxonomy.default_ordered_legal_ranks
-		if taxid not in NcbiTaxonomy.taxid_to_parent_taxid:
+		key = ("parent_taxid_of_legal_ranks", taxid, tuple(ranks))
+		parent = self._store.lookup_cache.get(key)
+		if parent is None:
+			parent = self._get_parent_taxid_of_legal_ranks(taxid, ranks)
+			self._store.lookup_cache.put(key, parent)
+		return parent
+
+	def _get_parent_taxid_of_legal_ranks(self, taxid, ranks):
+		"""uncached get_parent_taxid_of_legal_ranks."""
+		taxid = self.get_updated_taxid(taxid)
+		if taxid not in self._store.taxid_to_parent_taxid:
 			self._logger.error("No parent taxid available for taxid: {}".format(taxid))
 			raise ValueError("Invalid taxid")
-		taxid = NcbiTaxonomy.taxid_to_parent_taxid[taxid]
-		while taxid is not None and taxid != "1" and NcbiTaxonomy.taxid_to_rank[taxid] not in ranks:
-			taxid = NcbiTaxonomy.taxid_to_parent_taxid[taxid]
-		if NcbiTaxonomy.taxid_to_rank[taxid] not in ranks:
+		taxid = self._store.taxid_to_parent_taxid[taxid]
+		while taxid is not None and taxid != "1" and self._store.taxid_to_rank[taxid] not in ranks:
+			taxid = self._store.taxid_to_parent_taxid[taxid]
+		if self._store.taxid_to_rank[taxid] not in ranks:
 			return None, None
-		return taxid, NcbiTaxonomy.taxid_to_rank[taxid]
+		return taxid, self._store.taxid_to_rank[taxid]
 
+	def get_lca_index(self):
+		"""
+			Return the lowest common ancestor index of the taxonomy, built from the parent taxids on first use
+
+			@rtype: LcaIndex
+		"""
+		if self._get_local_store().lca_index is None:
+			if self._store.compiled is not None:
+				parents = self._store.compiled.parents
+			else:
+				parents, _, _ = taxonomy_arrays(self._store.taxid_to_parent_taxid, self._store.taxid_to_rank)
+			self._store.lca_index = LcaIndex(parents)
+		return self._store.lca_index
+
+	def _get_taxid_array(self, taxids):
+		"""current taxids as integer array, each distinct taxid is updated once."""
+		updated = {}
+		for taxid in taxids:
+			if taxid not in updated:
+				updated[taxid] = int(self.get_updated_taxid(taxid))
+		return array([updated[taxid] for taxid in taxids], dtype=int32)
+
+	@served
+	def get_lowest_common_ancestors(self, taxids_a, taxids_b):
+		"""
+			Return the lowest common ancestor of each pair of taxonomic identifiers
+
+			@param taxids_a: ncbi taxonomic identifiers, e.g. of the gold standard
+			@type taxids_a: list[basestring]
+			@param taxids_b: ncbi taxonomic identifiers, e.g. of the predictions, same length as taxids_a
+			@type taxids_b: list[basestring]
+
+			@return: ncbi taxonomic identifiers
+			@rtype: list[str]
+		"""
+		assert len(taxids_a) == len(taxids_b)
+		index = self.get_lca_index()
+		lowest_common_ancestors = index.lowest_common_ancestors(
+			self._get_taxid_array(taxids_a), self._get_taxid_array(taxids_b))
+		return [str(taxid) for taxid in lowest_common_ancestors.tolist()]
+
+	@served
+	def get_taxonomic_distances(self, taxids_a, taxids_b):
+		"""
+			Return the number of edges on the path between each pair of taxonomic identifiers
+
+			The path leads over the lowest common ancestor, so a distance of 0 means identical taxa and the distance
+			of a taxon to its ancestor is the number of nodes in between plus one.
+
+			@param taxids_a: ncbi taxonomic identifiers, e.g. of the gold standard
+			@type taxids_a: list[basestring]
+			@param taxids_b: ncbi taxonomic identifiers, e.g. of the predictions, same length as taxids_a
+			@type taxids_b: list[basestring]
+
+			@return: distances
+			@rtype: numpy.ndarray
+		"""
+		assert len(taxids_a) == len(taxids_b)
+		return self.get_lca_index().distances(self._get_taxid_array(taxids_a), self._get_taxid_array(taxids_b))
+
+	@served
+	def get_lowest_common_ancestors_and_distances(self, taxids_a, taxids_b):
+		"""
+			Return the lowest common ancestor and the taxonomic distance of each pair of taxonomic identifiers
+
+			Same as get_lowest_common_ancestors and get_taxonomic_distances, but the taxids are resolved and the
+			ancestors are searched only once.
+
+			@param taxids_a: ncbi taxonomic identifiers, e.g. of the gold standard
+			@type taxids_a: list[basestring]
+			@param taxids_b: ncbi taxonomic identifiers, e.g. of the predictions, same length as taxids_a
+			@type taxids_b: list[basestring]
+
+			@return: ncbi taxonomic identifiers and distances
+			@rtype: (list[str], numpy.ndarray)
+		"""
+		assert len(taxids_a) == len(taxids_b)
+		index = self.get_lca_index()
+		a = self._get_taxid_array(taxids_a)
+		b = self._get_taxid_array(taxids_b)
+		lowest_common_ancestors = index.lowest_common_ancestors(a, b)
+		distances = index.distances(a, b, lowest_common_ancestors)
+		return [str(taxid) for taxid in lowest_common_ancestors.tolist()], distances
+
+	@served
 	def get_parent_taxid(self, taxid):
 		"""
 			Return taxonomic identifier of the parent node
@@ -278,11 +647,12 @@ class NcbiTaxonomy(Validator):
 		"""
 		assert isinstance(taxid, basestring)
 		taxid = self.get_updated_taxid(taxid)
-		if taxid in NcbiTaxonomy.taxid_to_parent_taxid:
-			return NcbiTaxonomy.taxid_to_parent_taxid[taxid]
+		if taxid in self._store.taxid_to_parent_taxid:
+			return self._store.taxid_to_parent_taxid[taxid]
 		self._logger.error("No parent taxid available for taxid: {}".format(taxid))
 		raise ValueError("Invalid taxid")
 
+	@served
 	def get_rank_of_taxid(self, taxid):
 		"""
 			Return rank of ncbi taxonomic identifier
@@ -295,33 +665,80 @@ class NcbiTaxonomy(Validator):
 		"""
 		assert isinstance(taxid, basestring)
 		taxid = self.get_updated_taxid(taxid)
-		if taxid in NcbiTaxonomy.taxid_to_rank:
-			return NcbiTaxonomy.taxid_to_rank[taxid]
+		if taxid in self._store.taxid_to_rank:
+			return self._store.taxid_to_rank[taxid]
 		self._logger.error("No rank available for taxid: {}".format(taxid))
 		raise ValueError("Invalid taxid")
 
-	def _add_nodes(self, taxid, parent_taxid='', rank='', name=''):
-		"""insert nodes into taxonomy tree."""
-		new_node = TaxonomyNode.by_name.get(taxid)
+	def _read_dump_files(self, build_node_tree, components=None):
+		"""parse the NCBI dump files of the components into new dictionaries, the others are parsed on first access."""
+		if components is None or build_node_tree:
+			components = NcbiTaxonomy.components
+		assert set(components) <= set(NcbiTaxonomy.components), "Unknown taxonomy component"
+		self._store.compiled = None
+		self._store.loaded = True
+		for component, attributes in NcbiTaxonomy._component_attributes.iteritems():
+			for attribute in attributes:
+				if component in components:
+					setattr(self._store, attribute, {})
+				else:
+					setattr(self._store, attribute, LazyMapping(partial(self._read_component, component, attribute)))
+		self._build_ncbi_taxonomy(build_node_tree, components)
+		if "merged" in components:
+			self._read_merged_file()
 
-		if new_node is None:
-			TaxonomyNode(taxid, parent_taxid, rank, name)
-		# check rank
-		if rank == 'no rank':
-			return
-		ind1 = TaxonomyNode.allranks.index(rank)
+	def _read_component(self, component, attribute):
+		"""parse the dump file of a component on first access of one of its dictionaries and return this dictionary."""
+		if isinstance(getattr(self._store, attribute), LazyMapping):
+			self._logger.info("Reading taxonomy component on first access:\t'{}'".format(component))
+			for name in NcbiTaxonomy._component_attributes[component]:
+				setattr(self._store, name, {})
+			if component == "structure":
+				self._read_nodes_file()
+			elif component == "merged":
+				self._read_merged_file()
+			else:
+				self._read_names_file(False, component == "scientific_names", component == "name_index")
+		return getattr(self._store, attribute)
+
+	def _has_unread_components(self):
+		"""True if a component was not read yet."""
+		return any(
+			isinstance(getattr(self._store, attribute), LazyMapping)
+			for attributes in NcbiTaxonomy._component_attributes.itervalues() for attribute in attributes)
+
+	def _open_compiled_taxonomy(self, file_path):
+		"""use the read-only dictionaries of a compiled taxonomy file, False if it is missing or outdated."""
+		if not os.path.isfile(file_path):
+			return False
+		self._logger.info("Reading compiled taxonomy:\t'{}'".format(file_path))
+		try:
+			compiled = CompiledTaxonomy(file_path)
+		except ValueError as e:
+			self._logger.warning("Ignoring compiled taxonomy: {}".format(e))
+			return False
+		self._store.compiled = compiled
+		self._store.loaded = True
+		self._store.reset_indexes()
+		self._store.name_to_taxids = compiled.name_to_taxids
+		self._store.taxid_to_parent_taxid = compiled.taxid_to_parent_taxid
+		self._store.taxid_to_name = compiled.taxid_to_name
+		self._store.taxid_to_rank = compiled.taxid_to_rank
+		self._store.taxid_old_to_taxid_new = compiled.taxid_old_to_taxid_new
+		return True
+
+	def _write_compiled_taxonomy(self, file_path, ignore_errors=True):
+		"""write the dictionaries into a compiled taxonomy file, a failure is not fatal unless errors are not ignored."""
+		self._logger.info("Writing compiled taxonomy:\t'{}'".format(file_path))
+		store = self._store
 		try:
-			if not TaxonomyNode.by_name[parent_taxid].rank == 'no rank':
-				ind2 = TaxonomyNode.allranks.index(TaxonomyNode.by_name[parent_taxid].rank)
-				assert ind1 >= ind2
-				# e.g. Ovis aries platyura ('species'), Oves aries ('species')
-		except KeyError:
-			self._logger.debug("__add_nodes KeyError: {}".format(parent_taxid))
-			pass
-		# add new node to parent's all_child_nodes
-		# while parent_taxid in Node.byname:
-		#    Node.byname[parent_taxid].all_child_nodes.add(newnode)
-		#    parent_taxid = Node.byname[parent_taxid].taxid
+			write_compiled_taxonomy(
+				file_path, store.taxid_to_parent_taxid, store.taxid_to_rank, store.taxid_to_name,
+				store.taxid_old_to_taxid_new, store.name_to_taxids, NcbiTaxonomy.default_ordered_legal_ranks)
+		except (IOError, OSError) as e:
+			if not ignore_errors:
+				raise
+			self._logger.warning("Could not write compiled taxonomy '{}': {}".format(file_path, e))
 
 	@staticmethod
 	def _insert_into_dict(taxid, name, my_dict):
@@ -331,11 +748,12 @@ class NcbiTaxonomy(Validator):
 			my_dict[name] = set()
 		my_dict[name].add(taxid)
 
-	def _build_ncbi_taxonomy(self, build_node_tree):
-		""" parse NCBI taxonomy files."""
+	def _build_ncbi_taxonomy(self, build_node_tree, components=None):
+		""" parse NCBI taxonomy files of the components, by default all."""
+		if components is None:
+			components = NcbiTaxonomy.components
 		self._logger.info("Building taxonomy tree...")
-		if build_node_tree:
-			TaxonomyNode.by_name.clear()
+		self._store.reset_indexes()
 
 		# names.dmp (taxid, name, unique name, name class):
 		# 521095	|	Atopobium parvulum ATCC 33793	|		|	synonym	|
@@ -352,70 +770,66 @@ class NcbiTaxonomy(Validator):
 		# 	1382	|	Streptococcus parvulus (Weinberg et al. 1937) Cato 1983	|		|	synonym	|
 		# 	1382	|	not "Streptococcus parvulus" Levinthal 1928	|		|	synonym	|
 
+		if "structure" in components:
+			self._read_nodes_file()
+		if build_node_tree:
+			parents, ranks, rank_names = taxonomy_arrays(self._store.taxid_to_parent_taxid, self._store.taxid_to_rank)
+			TaxonomyNode.build(parents, ranks, rank_names, self._store.taxid_to_name)
+			self._store.node_tree = TaxonomyNode.tree
+		if "scientific_names" in components or "name_index" in components:
+			self._read_names_file(build_node_tree, "scientific_names" in components, "name_index" in components)
+
+	# read NCBI nodes file
+	def _read_nodes_file(self):
 		self._logger.info("Reading 'nodes' file:\t'{}'".format(self._file_path_ncbi_nodes))
-		with open(self._file_path_ncbi_nodes) as file_handler:
-			for line in file_handler:
-				elements = [el.strip() for el in line.split('|')]
-				taxid, parent_taxid, rank = elements[0:3]
-				rank = rank.lower()  # should be lower-case in file, but can't be bad to doublecheck
-				NcbiTaxonomy.taxid_to_parent_taxid[taxid] = parent_taxid
-				NcbiTaxonomy.taxid_to_rank[taxid] = rank
-				if not build_node_tree:
-					continue
-				assert taxid not in TaxonomyNode.by_name
-				self._add_nodes(taxid, parent_taxid=parent_taxid, rank=rank)
-
-		with open(self._file_path_ncbi_names) as file_handler:
-			for line in file_handler:
-				taxid, name, unique, name_class, sonst = [el.strip() for el in line.split('|')]
-				self._insert_into_dict(taxid, name, NcbiTaxonomy.name_to_taxids)
-				if not build_node_tree:
-					continue
-				try:
-					my_node = TaxonomyNode.by_name[taxid]
-					assert taxid == my_node.taxid
-				except KeyError:
+		for taxid_to_parent_taxid, taxid_to_rank in parse_dump_file(self._file_path_ncbi_nodes, parse_nodes, jobs=self._jobs):
+			self._store.taxid_to_parent_taxid.update(taxid_to_parent_taxid)
+			self._store.taxid_to_rank.update(taxid_to_rank)
+
+	# read NCBI names file
+	def _read_names_file(self, build_node_tree, scientific_names=True, name_index=True):
+		"""read the name index and scientific names, and the names of the node tree, in one pass."""
+		self._logger.info("Reading 'names' file:\t'{}'".format(self._file_path_ncbi_names))
+		for name_to_taxids, taxid_to_name, rows in parse_dump_file(
+				self._file_path_ncbi_names, parse_names, (name_index, scientific_names, build_node_tree), jobs=self._jobs):
+			# the dictionaries of a component which is not read are placeholders
+			if name_index:
+				for name, taxids in name_to_taxids.iteritems():
+					if name in self._store.name_to_taxids:
+						self._store.name_to_taxids[name].update(taxids)
+					else:
+						self._store.name_to_taxids[name] = taxids
+			if scientific_names:
+				self._store.taxid_to_name.update(taxid_to_name)
+			for taxid, name, unique, name_class in rows:
+				if taxid not in TaxonomyNode.by_name:
 					self._logger.error("build_ncbi_taxonomy KeyError: {}".format(taxid))
 					continue
 
 				if name_class == 'scientific name':
-					my_node.unique_name = unique
-					my_node.scientific_name = name
+					if unique:
+						TaxonomyNode.unique_names[taxid] = unique
+					TaxonomyNode.add_scientific_name(taxid, name)
 
 				elif name_class == 'synonym':
-					my_node.synonyms.append(name)
+					TaxonomyNode.synonyms_by_taxid.setdefault(taxid, []).append(name)
 					# example: Bacteroides corrodens: Campylobacter ureolyticus (taxid 827), Eikenella corrodens (taxid 539)
 					self._insert_into_dict(taxid, name, TaxonomyNode.by_synonym)
 
 				elif name_class == 'equivalent name':
-					my_node.equivalent_name.append(name)
+					TaxonomyNode.equivalent_names_by_taxid.setdefault(taxid, []).append(name)
 					self._insert_into_dict(taxid, name, TaxonomyNode.by_equivalent)
 
 				elif name_class == 'in-part' or name_class == 'includes' or \
 					name_class == 'blast name' or name_class == 'genbank common name' or\
 					name_class == 'misspelling' or name_class == 'authority':
 					pass
-		# update the taxonomy!
-		TaxonomyNode.update()
-
-	# read NCBI names file
-	def _read_names_file(self):
-		with open(self._file_path_ncbi_names) as fin:
-			self._logger.info("Reading 'names' file:\t'{}'".format(self._file_path_ncbi_names))
-			for line in fin:
-				# 65      |       Herpetosiphon aurantiacus       |               |       scientific name |
-				taxid, name, disambiguation, nametype, more = line.strip().split('|')
-				if nametype.strip() == 'scientific name':
-					NcbiTaxonomy.taxid_to_name[taxid.strip()] = name.strip()
 
 	# read NCBI merged file
 	def _read_merged_file(self):
-		with open(self._file_path_ncbi_merged) as fin:
-			self._logger.info("Reading 'merged' file:\t'{}'".format(self._file_path_ncbi_merged))
-			for line in fin:
-				# 5085       |       746128  |
-				old_taxid, new_taxid, sonst = line.strip().split('|')
-				NcbiTaxonomy.taxid_old_to_taxid_new[old_taxid.strip()] = new_taxid.strip()
+		self._logger.info("Reading 'merged' file:\t'{}'".format(self._file_path_ncbi_merged))
+		for taxid_old_to_taxid_new in parse_dump_file(self._file_path_ncbi_merged, parse_merged, jobs=self._jobs):
+			self._store.taxid_old_to_taxid_new.update(taxid_old_to_taxid_new)
 
 	# ###############
 	# newick
@@ -1,160 +1,241 @@
 __author__ = 'hofmann'
 # original from Dmitrij Turaev
 
-import sys
+from collections import Mapping
+from numpy import argsort, flatnonzero
+from taxonomytree import TaxonomyTree
+
+
+class _NodesByTaxid(Mapping):
+	"""taxid -> TaxonomyNode of TaxonomyNode.tree"""
+
+	def __getitem__(self, taxid):
+		tree = TaxonomyNode.tree
+		try:
+			index = int(taxid)
+		except (TypeError, ValueError):
+			raise KeyError(taxid)
+		if tree is None or str(index) != taxid:
+			raise KeyError(taxid)
+		return TaxonomyNode(tree.position(index))
+
+	def __iter__(self):
+		tree = TaxonomyNode.tree
+		if tree is None:
+			return iter(())
+		return (str(taxid) for taxid in tree.taxids.tolist())
+
+	def __len__(self):
+		return 0 if TaxonomyNode.tree is None else len(TaxonomyNode.tree)
+
+
+class _NodesByRank(Mapping):
+	"""rank -> list of TaxonomyNode of TaxonomyNode.tree, ordered by taxid"""
+
+	def __getitem__(self, rank):
+		tree = TaxonomyNode.tree
+		if tree is None or rank not in tree.rank_names:
+			raise KeyError(rank)
+		positions = flatnonzero(tree.ranks == tree.rank_names.index(rank))
+		positions = positions[argsort(tree.taxids[positions], kind="mergesort")]
+		return [TaxonomyNode(position) for position in positions.tolist()]
+
+	def __iter__(self):
+		tree = TaxonomyNode.tree
+		if tree is None:
+			return iter(())
+		return iter([tree.rank_names[code] for code in sorted(set(tree.ranks.tolist()))])
+
+	def __len__(self):
+		return 0 if TaxonomyNode.tree is None else len(set(TaxonomyNode.tree.ranks.tolist()))
 
 
 class TaxonomyNode(object):
 	"""class to describe NCBI taxonomy tree.
-	
-	This class has to know: parent, children, taxid, rank, gi(?), 
+
+	This class has to know: parent, children, taxid, rank, gi(?),
 	scientific name, synonyms(?), equivalent name(?)
+
+	A node is a view on a position of the array-backed TaxonomyNode.tree, which
+	is built at once with TaxonomyNode.build. Nodes compare equal by position.
 	"""
 	allranks = [
 		'root', 'superkingdom', 'kingdom', 'subkingdom', 'superphylum', 'phylum',
 		'subphylum', 'superclass', 'class', 'subclass', 'infraclass', 'superorder', 'order', 'suborder',
 		'infraorder', 'parvorder', 'superfamily', 'family', 'subfamily', 'tribe', 'subtribe', 'genus',
 		'subgenus', 'species group', 'species subgroup', 'species', 'subspecies', 'varietas', 'forma']
-	by_name = {}
-	by_rank = {}
+	tree = None
+	scientific_names = {}
+	unique_names = {}
+	synonyms_by_taxid = {}
+	equivalent_names_by_taxid = {}
+	by_name = _NodesByTaxid()
+	by_rank = _NodesByRank()
 	by_synonym = {}
 	by_equivalent = {}
 	by_scientific_name = {}
 	ambiguous = {}
 	inactive_top_nodes = []
 	user_provided = []
-	# counter = 0
-	
-	def __set_scientific_name(self, name):
-		# ~ print name
-		self._scientific_name = name
+
+	__slots__ = ("_position",)
+
+	def __init__(self, position):
+		""" view on the node at a position of the tree. """
+		self._position = position
+
+	@staticmethod
+	def build(parents, ranks, rank_names, scientific_names):
+		"""
+			Build the tree and reset the name dictionaries
+
+			@param parents: parent taxid of each taxid, negative for unused taxids
+			@type parents: numpy.ndarray
+			@param ranks: rank code of each taxid
+			@type ranks: numpy.ndarray
+			@param rank_names: rank of each rank code
+			@type rank_names: list[str]
+			@param scientific_names: taxid -> scientific name, may be filled later
+			@type scientific_names: dict[str, str]
+
+			@rtype: None
+		"""
+		TaxonomyNode.tree = TaxonomyTree(parents, ranks, rank_names)
+		TaxonomyNode.scientific_names = scientific_names
+		TaxonomyNode.unique_names = {}
+		TaxonomyNode.synonyms_by_taxid = {}
+		TaxonomyNode.equivalent_names_by_taxid = {}
+		TaxonomyNode.by_synonym.clear()
+		TaxonomyNode.by_equivalent.clear()
+		TaxonomyNode.by_scientific_name.clear()
+		del TaxonomyNode.inactive_top_nodes[:]
+
+	@staticmethod
+	def add_scientific_name(taxid, name):
+		""" register the scientific name of a taxid in by_scientific_name. """
 		key = name.lower()
 		if not key:
 			return
 		if key not in TaxonomyNode.by_scientific_name:
-			TaxonomyNode.by_scientific_name[key] = self.taxid
+			TaxonomyNode.by_scientific_name[key] = taxid
 			return
 		# problem: two identical scientific names; examples:
 		# Bironella / Bironella <subgenus>
 		# Bacillus <stick insect> / Bacillus <bacterium>
-		# #newkey = Node.bysciname[key].unique_name.lower()
-		# #if newkey:
-		# #	Node.bysciname[newkey] = Node.bysciname[key]
-		# #	del Node.bysciname[key]
-		# #newnewkey = self.unique_name.lower()
-		# assert that there was a solution for the problem
-		# #assert newkey or newnewkey
-		# #if newnewkey:
-		# #	assert newkey != newnewkey
-		# #	Node.bysciname[newnewkey] = self
-		# #else:
-		# #	Node.bysciname[key] = self
-		# ## check if the unique name works correctly, e.g. for carma !!!!!!
-		# dictionary for ambiguous cases
-		# #Node.ambiguous[key] = [k for k in [key, newkey, newnewkey] if Node.bysciname.get(k)]
 		if isinstance(TaxonomyNode.by_scientific_name[key], list):
-			TaxonomyNode.by_scientific_name[key].append(self.taxid)
+			TaxonomyNode.by_scientific_name[key].append(taxid)
 		else:
 			assert int(TaxonomyNode.by_scientific_name[key])
-			TaxonomyNode.by_scientific_name[key] = [TaxonomyNode.by_scientific_name[key], self.taxid]
-
-	def __get_scientific_name(self):
-		return self._scientific_name
-	scientific_name = property(__get_scientific_name, __set_scientific_name)
-
-	def __init__(self, taxid, parent_taxid, rank='', name='', unique_name=''):
-		""" constructor. """
-		self.taxid = taxid
-		self.rank = rank
-		# ~ self.sciname = name
-		self.scientific_name = name
-		self.synonyms = []
-		self.equivalent_name = []
-		self.gi = ''
-		self.parent = None
-		self.parent_taxid = parent_taxid
-		self.children = set()
-		self.leafs = set()
-		self.lineage = []
-		# ~ self.all_child_nodes = []
-		self.all_child_nodes = set()  # higher performance?
-		self.node_active = True
-		self.unique_name = unique_name
-
-		assert taxid not in TaxonomyNode.by_name
-		TaxonomyNode.by_name[taxid] = self
-		TaxonomyNode.by_rank.setdefault(rank, []).append(self)
-		if taxid.startswith('[u]'):
-			TaxonomyNode.user_provided.append(self)
+			TaxonomyNode.by_scientific_name[key] = [TaxonomyNode.by_scientific_name[key], taxid]
+
+	def __eq__(self, other):
+		return isinstance(other, TaxonomyNode) and self._position == other._position
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return self._position
+
+	def __repr__(self):
+		return "TaxonomyNode({})".format(self.taxid)
+
+	@property
+	def taxid(self):
+		return str(TaxonomyNode.tree.taxids[self._position])
+
+	@property
+	def rank(self):
+		tree = TaxonomyNode.tree
+		return tree.rank_names[tree.ranks[self._position]]
+
+	@property
+	def scientific_name(self):
+		return TaxonomyNode.scientific_names.get(self.taxid, '')
+
+	@property
+	def unique_name(self):
+		return TaxonomyNode.unique_names.get(self.taxid, '')
+
+	@property
+	def synonyms(self):
+		return TaxonomyNode.synonyms_by_taxid.get(self.taxid, [])
+
+	@property
+	def equivalent_name(self):
+		return TaxonomyNode.equivalent_names_by_taxid.get(self.taxid, [])
+
+	@property
+	def gi(self):
+		return ''
+
+	@property
+	def parent(self):
+		return TaxonomyNode(int(TaxonomyNode.tree.parents[self._position]))
+
+	@property
+	def parent_taxid(self):
+		return self.parent.taxid
+
+	@property
+	def children(self):
+		return set(TaxonomyNode(position) for position in TaxonomyNode.tree.children_of(self._position).tolist())
+
+	@property
+	def leafs(self):
+		return set(TaxonomyNode(position) for position in TaxonomyNode.tree.leaves(self._position).tolist())
+
+	@property
+	def lineage(self):
+		return self.get_lineage()
+
+	@property
+	def all_child_nodes(self):
+		return self.get_all_descendant_taxids()
+
+	def __get_node_active(self):
+		return bool(TaxonomyNode.tree.active[self._position])
+
+	def __set_node_active(self, active):
+		TaxonomyNode.tree.active[self._position] = active
+	node_active = property(__get_node_active, __set_node_active)
 
 	def update_node(self):
-		""" update nodes with some information which depends on
-		their neighborhood and should be done after all nodes are created. """
-		# replace parent taxids by the parent objects themselves
-		self.parent = TaxonomyNode.by_name[self.parent_taxid]
-		# tell parents that they have children
-		# ~ import pdb; pdb.set_trace()
-		# ~ if self not in self.parent.children:
-		# ~ Node.counter += 1
-		# ~ if Node.counter % 1000 == 0: print self.counter
-		self.parent.children.add(self)
-		# update the "bysciname" dictionary using "parent:child" as key
-		# ~ assert self.parent.sciname
-		# ~ key = ':'.join([self.parent.sciname.lower(), self.sciname.lower()])
-		# ~ key = self.sciname.lower()
-		# ~ self.bysciname[key] = self
-		# ~ print key; import pdb; pdb.set_trace()
+		""" nothing to do, the tree is built at once. """
+		pass
 
 	def get_leafs(self, leafs=None):
 		""" get the terminal leafs for a particular node."""
 		if leafs is None:
-			if self.leafs:
-				return	  # leafs are already known, nothing to do
-			leafs = self.leafs  # starting point
-		if self.children:
-			for child in self.children:
-				child.get_leafs(leafs)
-		else:
-			leafs.add(self)
+			return self.leafs
+		leafs.update(self.leafs)
+		return leafs
 
 	def get_child_nodes(self, child_nodes=None):
 		""" get all child nodes (not only the direct children) for a particular node. """
-		if child_nodes is None:  # starting point
-			# ~ del self.all_child_nodes[:]
-			# ~ self.all_child_nodes.clear()
-			if self.all_child_nodes:
-				return	 # nothing to do
-			child_nodes = self.all_child_nodes
-		else:
-			# #~ if self not in child_nodes:
-			# ~ child_nodes.append(self)
-			child_nodes.add(self.taxid)
-		if self.children:
-			for child in self.children:
-				if child.taxid == '1':
-					continue  # don't get caught in infinite loop
-				child.get_child_nodes(child_nodes)
+		if child_nodes is None:
+			return self.all_child_nodes
+		child_nodes.update(self.all_child_nodes)
+		return child_nodes
 
 	def get_all_descendant_taxids(self):
 		""" return taxids of all descendants """
-		self.get_child_nodes()
-		# return set(node.taxid for node in self.all_child_nodes)
-		return self.all_child_nodes
+		tree = TaxonomyNode.tree
+		return set(str(taxid) for taxid in tree.taxids[self._position + 1:tree.ends[self._position]].tolist())
 
 	def get_lineage(self, lineage=None):
-		""" get taxonomy lineage up to the root for this node """
-		if lineage is None:
-			lineage = []
-		lineage.append(self.taxid)
-		if self.taxid == '1':
-			return list(reversed(lineage))
-		else:
-			return self.parent.get_lineage(lineage)
+		""" get taxonomy lineage from the root to this node """
+		taxids = TaxonomyNode.tree.taxids
+		return [str(taxids[position]) for position in TaxonomyNode.tree.lineage(self._position)]
+
+	def is_descendant_of(self, node):
+		""" test if this node is in the subtree of another node (or the node itself). """
+		return bool(TaxonomyNode.tree.is_descendant(self._position, node._position))
 
 	@staticmethod
 	def update():
-		for key, my_node in TaxonomyNode.by_name.items():
-			my_node.update_node()
+		""" nothing to do, the tree is built at once. """
+		pass
 
 	@staticmethod
 	def active_parent_nodes_consistency(oCurrNode):
@@ -166,59 +247,30 @@ class TaxonomyNode(object):
 			child nodes will be inactivated.
 			Returns the last node that has a parent with at least one active child.
 		"""
-		try:
-			bCheckActiveChildNodes = False
-			oChildrenNodes = oCurrNode.parent.children
-			for oChildNode in oChildrenNodes:
-				bCheckActiveChildNodes = bCheckActiveChildNodes or oChildNode.node_active
-
-			if not bCheckActiveChildNodes:
-				oCurrNode.parent.node_active = False
-				oCurrNode = TaxonomyNode.active_parent_nodes_consistency(oCurrNode.parent)
-
-		except Exception as e:
-			print >> sys.stderr, str(e)
-			# logging.error(str(e))
-
-		return oCurrNode
+		return TaxonomyNode(TaxonomyNode.tree.inactivate_parents(oCurrNode._position))
 
 	@staticmethod
 	def inactivate_branch(taxid):
 		""" inactivate_branch(taxid)
 			taxid ... ncbi taxonomy id
 			------------------------------------------------------------------------
-			Inactivates an ncbi taxonomy node with id = taxid including all 
-			children by changing node attribute "node_active" to False. 
-			Furthermore inactivates all successive parent nodes, which 
-			have no active child nodes. Adds the top inactivated node within 
-			the inactivated branch to class dictionary Node.inactive_top_nodes 
+			Inactivates an ncbi taxonomy node with id = taxid including all
+			children by changing node attribute "node_active" to False.
+			Furthermore inactivates all successive parent nodes, which
+			have no active child nodes. Adds the top inactivated node within
+			the inactivated branch to class dictionary Node.inactive_top_nodes
 			to permit a reactivation of this branch later on.
 		"""
-		try:
-			oCurrNode = TaxonomyNode.by_name.get(str(taxid))
-			if not oCurrNode.all_child_nodes:
-				oCurrNode.get_child_nodes()
-			oCurrNode.node_active = False
-			for oChildNode in oCurrNode.all_child_nodes:
-				oChildNode.node_active = False
-
-			oCurrNode = TaxonomyNode.active_parent_nodes_consistency(oCurrNode)
-
-			TaxonomyNode.inactive_top_nodes.append(oCurrNode)
-
-		except Exception as e:
-			print >> sys.stderr, str(e)
-			# logging.error(str(e))
+		oCurrNode = TaxonomyNode.by_name[str(taxid)]
+		position = TaxonomyNode.tree.inactivate(oCurrNode._position)
+		TaxonomyNode.inactive_top_nodes.append(TaxonomyNode(position))
 
 	@staticmethod
 	def activate_branch(taxid):
 		""" "activate" a branch of the taxonomy tree. """
-		oCurrNode = TaxonomyNode.by_name.get(str(taxid))
+		oCurrNode = TaxonomyNode.by_name[str(taxid)]
 		TaxonomyNode.inactive_top_nodes.remove(oCurrNode)
-		oCurrNode.get_child_nodes()
-		oCurrNode.node_active = True
-		for oChildNode in oCurrNode.all_child_nodes:
-			oChildNode.node_active = True
+		TaxonomyNode.tree.activate(oCurrNode._position)
 
 	@staticmethod
 	def find_parent_by_rank(oCurrNode, vFindParentRank, origNode=None, takeLowerIfMissing=False):
@@ -226,36 +278,16 @@ class TaxonomyNode(object):
 		root (no rank); viruses (superkingdom); unclassified phages (no rank); Streptococcus phage YMC-2011 (species)
 		cellular organisms; Bacteria; Cyanobacteria (phylum); Chroococcales (order); Cyanothece; Cyanothece sp. (rank "class" missing)
 		"""
-		if oCurrNode.sciname == 'root':  # last resort
-			return False
-		vFindParentRank = vFindParentRank.lower().strip()
-		if not origNode:
-			origNode = oCurrNode   # remember starting point
-		target_ind = TaxonomyNode.allranks.index(vFindParentRank)
-		# if origNode has rank 'no rank', go on with its parent
-		try:
-			my_ind = TaxonomyNode.allranks.index(oCurrNode.rank)
-		except ValueError:
-			assert oCurrNode.rank == 'no rank'
-			return TaxonomyNode.find_parent_by_rank(oCurrNode.parent, vFindParentRank, origNode)
-		# if parent node has rank 'no rank', go on with its parent
-		parent_ind = None
-		while not parent_ind:
-			try:
-				parent_ind = TaxonomyNode.allranks.index(oCurrNode.parent.rank)
-			except ValueError:
-				assert oCurrNode.parent.rank == 'no rank'
-				oCurrNode = oCurrNode.parent
-		# check the rank positions
-		if my_ind == target_ind:		# it's me
-			oReturnParentNode = oCurrNode
-		elif parent_ind == target_ind:  # it's my parent
-			oReturnParentNode = oCurrNode.parent
-		elif parent_ind < target_ind:   # missed it
-			if takeLowerIfMissing:
-				oReturnParentNode = oCurrNode
-			else:
-				oReturnParentNode = False
-		else:
-			oReturnParentNode = TaxonomyNode.find_parent_by_rank(oCurrNode.parent, vFindParentRank, origNode)
-		return oReturnParentNode
\ No newline at end of file
+		target_ind = TaxonomyNode.allranks.index(vFindParentRank.lower().strip())
+		lower_node = False
+		# nodes with a rank which is not in allranks (e.g. 'no rank') are skipped
+		while oCurrNode._position != 0:
+			if oCurrNode.rank in TaxonomyNode.allranks:
+				my_ind = TaxonomyNode.allranks.index(oCurrNode.rank)
+				if my_ind == target_ind:  # it's me
+					return oCurrNode
+				if my_ind < target_ind:  # missed it
+					return lower_node if takeLowerIfMissing else False
+				lower_node = oCurrNode
+			oCurrNode = oCurrNode.parent
+		return False  # last resort
@@ -0,0 +1,273 @@
+"""
+Lookup server which holds NCBI taxonomies in memory and answers the lookups of NcbiTaxonomy objects of other processes.
+
+The server listens on a Unix socket, which only its user can access. A client opens a taxonomy by its directory and
+fingerprint, the server loads each taxonomy version once. Requests are batches of NcbiTaxonomy method calls, the
+results or exceptions are sent back in the same order. Messages are pickled and prefixed by their length.
+"""
+
+import os
+import socket
+import threading
+import cPickle
+from struct import pack, unpack
+from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+_header_size = 8
+
+
+def send_message(stream, message):
+	"""
+		Write a pickled message with its length
+
+		@param stream: writable file object of a socket
+		@type stream: file
+		@param message: picklable message
+
+		@rtype: None
+	"""
+	data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+	stream.write(pack("<Q", len(data)) + data)
+	stream.flush()
+
+
+def receive_message(stream):
+	"""
+		Read a message written by send_message
+
+		@param stream: readable file object of a socket
+		@type stream: file
+
+		@return: message or None if the connection was closed
+	"""
+	header = stream.read(_header_size)
+	if len(header) < _header_size:
+		return None
+	size, = unpack("<Q", header)
+	data = stream.read(size)
+	if len(data) < size:
+		return None
+	return cPickle.loads(data)
+
+
+def _picklable(exception):
+	"""the exception, or a RuntimeError with its description if it cannot be pickled."""
+	try:
+		cPickle.dumps(exception, cPickle.HIGHEST_PROTOCOL)
+		return exception
+	except Exception:
+		return RuntimeError("{}: {}".format(type(exception).__name__, exception))
+
+
+class _RequestHandler(StreamRequestHandler):
+	"""Answers the messages of one connection until it is closed"""
+
+	def handle(self):
+		while True:
+			message = receive_message(self.rfile)
+			if message is None:
+				return
+			try:
+				reply = ("ok", self.server.answer(message))
+			except Exception as e:
+				reply = ("error", _picklable(e))
+			send_message(self.wfile, reply)
+			if message[0] == "stop":
+				# the reply is written, so the client sees it even if the process exits right away
+				self.server.stop()
+				return
+
+
+class TaxonomyServer(ThreadingMixIn, UnixStreamServer):
+	"""Unix socket server with one NcbiTaxonomy object per taxonomy version"""
+
+	daemon_threads = True
+
+	def __init__(self, socket_path, served_methods):
+		"""
+			Bind the socket, a stale socket file of a server which is gone is replaced
+
+			@param socket_path: file path of the socket
+			@type socket_path: str | unicode
+			@param served_methods: names of the NcbiTaxonomy methods which clients may call
+			@type served_methods: collections.Iterable[str]
+
+			@raise socket.error: if another server listens on the socket
+		"""
+		if os.path.exists(socket_path):
+			if TaxonomyClient.connect(socket_path) is not None:
+				raise socket.error("A taxonomy server is already listening on '{}'".format(socket_path))
+			os.remove(socket_path)
+		self.socket_path = socket_path
+		self._served_methods = frozenset(served_methods)
+		self._taxonomies = {}
+		self._lock = threading.Lock()
+		mask = os.umask(0o077)
+		try:
+			UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+		finally:
+			os.umask(mask)
+
+	def open_taxonomy(self, taxonomy_directory, cache_file=None, fingerprint=None):
+		"""
+			Load a taxonomy unless the same version is loaded already
+
+			@param taxonomy_directory: directory containing ncbi dump
+			@type taxonomy_directory: str | unicode
+			@param cache_file: file path of compiled taxonomy
+			@type cache_file: None | str | unicode
+			@param fingerprint: fingerprint of the taxonomy version, by default the one of NcbiTaxonomy
+			@type fingerprint: None | str
+
+			@return: fingerprint of the taxonomy version
+			@rtype: str
+		"""
+		from ncbitaxonomy import NcbiTaxonomy
+		with self._lock:
+			if fingerprint is None or fingerprint not in self._taxonomies:
+				taxonomy = NcbiTaxonomy(
+					taxonomy_directory, False, verbose=False, cache_file=cache_file, fingerprint=fingerprint,
+					socket_path="")
+				fingerprint = taxonomy.fingerprint
+				self._taxonomies.setdefault(fingerprint, taxonomy)
+		return fingerprint
+
+	def answer(self, message):
+		"""
+			Answer a message of a client
+
+			('open', taxonomy directory, cache file, fingerprint): fingerprint of the loaded taxonomy
+			('call', fingerprint, [(method name, arguments, keyword arguments), ...]): list of ('ok', result) or
+				('error', exception) for each call
+			('stop', ): None, the request handler shuts the server down after the reply
+
+			@rtype: object
+		"""
+		if message[0] == "open":
+			return self.open_taxonomy(*message[1:])
+		if message[0] == "call":
+			fingerprint, calls = message[1:]
+			taxonomy = self._taxonomies[fingerprint]
+			results = []
+			with self._lock:
+				for method, arguments, keyword_arguments in calls:
+					try:
+						if method not in self._served_methods:
+							raise ValueError("Method is not served: '{}'".format(method))
+						results.append(("ok", getattr(taxonomy, method)(*arguments, **keyword_arguments)))
+					except Exception as e:
+						results.append(("error", _picklable(e)))
+			return results
+		if message[0] == "stop":
+			return None
+		raise ValueError("Unknown request: '{}'".format(message[0]))
+
+	def stop(self):
+		"""
+			Shut the server down, serve_forever returns
+
+			@rtype: None
+		"""
+		# shutdown waits for serve_forever, which must not be blocked by the calling request
+		threading.Thread(target=self.shutdown).start()
+
+	def server_close(self):
+		UnixStreamServer.server_close(self)
+		if os.path.exists(self.socket_path):
+			os.remove(self.socket_path)
+
+
+class TaxonomyClient(object):
+	"""Connection to a taxonomy server"""
+
+	def __init__(self, connection):
+		"""
+			@param connection: connected Unix socket
+			@type connection: socket.socket
+		"""
+		self._connection = connection
+		self._reader = connection.makefile("rb")
+		self._writer = connection.makefile("wb")
+
+	@staticmethod
+	def connect(socket_path):
+		"""
+			Connect to a taxonomy server
+
+			@param socket_path: file path of the socket
+			@type socket_path: str | unicode
+
+			@return: client or None if no server listens on the socket
+			@rtype: TaxonomyClient | None
+		"""
+		connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			connection.connect(socket_path)
+		except socket.error:
+			connection.close()
+			return None
+		return TaxonomyClient(connection)
+
+	def _request(self, message):
+		send_message(self._writer, message)
+		reply = receive_message(self._reader)
+		if reply is None:
+			raise IOError("Connection to taxonomy server closed")
+		status, value = reply
+		if status == "error":
+			raise value
+		return value
+
+	def open_taxonomy(self, taxonomy_directory, cache_file=None, fingerprint=None):
+		"""
+			Let the server load a taxonomy, see TaxonomyServer.open_taxonomy
+
+			@return: fingerprint of the taxonomy version
+			@rtype: str
+		"""
+		return self._request(("open", taxonomy_directory, cache_file, fingerprint))
+
+	def call_many(self, fingerprint, calls):
+		"""
+			Call methods of the NcbiTaxonomy object of the server in one request
+
+			@param fingerprint: fingerprint of an opened taxonomy version
+			@type fingerprint: str
+			@param calls: method name, arguments and keyword arguments of each call
+			@type calls: list[(str, tuple, dict)]
+
+			@return: ('ok', result) or ('error', exception) of each call
+			@rtype: list[(str, object)]
+		"""
+		return self._request(("call", fingerprint, calls))
+
+	def call(self, fingerprint, method, arguments=(), keyword_arguments=None):
+		"""
+			Call a method of the NcbiTaxonomy object of the server
+
+			@raise Exception: the exception raised by the method
+			@return: result of the method
+		"""
+		status, value = self.call_many(fingerprint, [(method, tuple(arguments), keyword_arguments or {})])[0]
+		if status == "error":
+			raise value
+		return value
+
+	def stop(self):
+		"""
+			Shut the server down
+
+			@rtype: None
+		"""
+		self._request(("stop", ))
+		self.close()
+
+	def close(self):
+		"""
+			Close the connection
+
+			@rtype: None
+		"""
+		self._reader.close()
+		self._writer.close()
+		self._connection.close()
@@ -0,0 +1,65 @@
+"""
+Storage of one version of the NCBI taxonomy, shared by all NcbiTaxonomy objects of this version.
+
+NcbiTaxonomy keeps a registry of the stores by a fingerprint of the dump files, so several taxonomy versions can be
+loaded in one process. The dictionaries of a store are either parsed from the dump files or read-only views on a
+memory-mapped compiled taxonomy, whose pages are shared by forked processes.
+"""
+
+import os
+from hashlib import md5
+from lrucache import LruCache
+
+dump_files = ("names.dmp", "merged.dmp", "nodes.dmp")
+
+
+def taxonomy_fingerprint(taxonomy_directory):
+	"""
+		Fingerprint of the dump files of a taxonomy version, from their sizes and modification times
+
+		@param taxonomy_directory: directory containing ncbi dump
+		@type taxonomy_directory: str | unicode
+
+		@return: hexadecimal digest
+		@rtype: str
+	"""
+	digest = md5()
+	for file_name in dump_files:
+		status = os.stat(os.path.join(taxonomy_directory, file_name))
+		digest.update("{}\t{}\t{!r}\n".format(file_name, status.st_size, status.st_mtime))
+	return digest.hexdigest()
+
+
+class TaxonomyStore(object):
+	"""Dictionaries, compiled taxonomy, indexes and lookup cache of one taxonomy version"""
+
+	def __init__(self, fingerprint):
+		"""
+			@param fingerprint: fingerprint of the taxonomy version
+			@type fingerprint: str
+		"""
+		self.fingerprint = fingerprint
+		self.name_to_taxids = {}
+		self.taxid_to_parent_taxid = {}
+		self.taxid_to_name = {}
+		self.taxid_to_rank = {}
+		self.taxid_old_to_taxid_new = {}
+		self.loaded = False
+		self.has_node_tree = False
+		# TaxonomyTree built for this version, TaxonomyNode refers to the one built last in the process
+		self.node_tree = None
+		self.compiled = None
+		self.lca_index = None
+		self.name_index = None
+		# results of get_lineage, get_lineage_of_legal_ranks, get_parent_taxid_of_legal_ranks and get_scientific_name
+		self.lookup_cache = LruCache(2**16)
+
+	def reset_indexes(self):
+		"""
+			Drop the indexes and cached results, which are built from the dictionaries
+
+			@rtype: None
+		"""
+		self.lca_index = None
+		self.name_index = None
+		self.lookup_cache.clear()
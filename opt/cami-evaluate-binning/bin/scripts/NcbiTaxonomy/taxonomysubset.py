@@ -0,0 +1,88 @@
+"""
+Subset of the NCBI taxonomy with only the lineages of given taxids, written as dump files or as compiled taxonomy.
+
+The lines of the dump files are copied unchanged, so the subset gives the same lineages, names and merged ids for the
+given taxids as the complete taxonomy.
+"""
+
+import os
+from compiledtaxonomy import write_compiled_taxonomy
+from dumpparser import parse_merged_lines, parse_names_lines, parse_nodes_lines
+
+dump_files = ("nodes.dmp", "names.dmp", "merged.dmp")
+
+
+def lineage_taxids(taxonomy, taxids):
+	"""
+		Taxids of the lineages of taxids, merged ids are resolved and invalid taxids are skipped
+
+		@param taxonomy: taxonomy with structure and merged ids
+		@type taxonomy: NcbiTaxonomy
+		@param taxids: ncbi taxonomic identifiers
+		@type taxids: collections.Iterable[str]
+
+		@return: taxids of all nodes from the taxids up to the root and the merged ids among the taxids
+		@rtype: (set[str], set[str])
+	"""
+	lineages = set()
+	merged = set()
+	for taxid in set(taxids):
+		try:
+			current_taxid = taxonomy.get_updated_taxid(taxid)
+		except ValueError:
+			continue
+		if current_taxid != taxid:
+			merged.add(taxid)
+		for node in (current_taxid, taxonomy.lineage_substitutes.get(current_taxid)):
+			while node is not None and node not in lineages:
+				lineages.add(node)
+				parent = taxonomy.taxid_to_parent_taxid[node]
+				node = parent if parent != node else None
+	return lineages, merged
+
+
+def read_subset_lines(file_path, taxids):
+	"""
+		Lines of a dump file with a taxid of the set in the first column
+
+		@type file_path: str | unicode
+		@type taxids: set[str]
+
+		@rtype: list[str]
+	"""
+	with open(file_path) as file_handler:
+		return [line for line in file_handler if line.split("\t", 1)[0] in taxids]
+
+
+def write_taxonomy_subset(taxonomy_directory, taxids, merged, lineage_ranks, directory=None, cache_file=None):
+	"""
+		Write the nodes and names of taxids and the merged ids among merged as dump files and/or compiled taxonomy
+
+		@param taxonomy_directory: directory containing the complete ncbi dump
+		@type taxonomy_directory: str | unicode
+		@param taxids: taxids of the nodes, see lineage_taxids
+		@type taxids: set[str]
+		@param merged: merged ids
+		@type merged: set[str]
+		@param lineage_ranks: ranks of the ancestor table of the compiled taxonomy
+		@type lineage_ranks: list[str]
+		@param directory: output directory of the dump files
+		@type directory: None | str | unicode
+		@param cache_file: output file path of the compiled taxonomy
+		@type cache_file: None | str | unicode
+
+		@rtype: None
+	"""
+	nodes, names, merged_lines = [
+		read_subset_lines(os.path.join(taxonomy_directory, file_name), selection)
+		for file_name, selection in zip(dump_files, (taxids, taxids, merged))]
+	if directory is not None:
+		for file_name, lines in zip(dump_files, (nodes, names, merged_lines)):
+			with open(os.path.join(directory, file_name), "w") as file_handler:
+				file_handler.writelines(lines)
+	if cache_file is not None:
+		taxid_to_parent_taxid, taxid_to_rank = parse_nodes_lines(nodes)
+		name_to_taxids, taxid_to_name, _ = parse_names_lines(names)
+		write_compiled_taxonomy(
+			cache_file, taxid_to_parent_taxid, taxid_to_rank, taxid_to_name, parse_merged_lines(merged_lines),
+			name_to_taxids, lineage_ranks)
@@ -0,0 +1,190 @@
+"""
+Array-backed NCBI taxonomy tree.
+
+Nodes are numbered in pre-order (depth first, children by ascending taxid), so the subtree of a node is the range of
+positions from the node to the end of its subtree. Children are stored in compressed sparse rows, parents, depths,
+rank codes and an activity flag in one array each, indexed by position.
+"""
+
+from numpy import arange, bincount, concatenate, cumsum, flatnonzero, int32, int64, lexsort, ones, repeat, zeros
+
+
+def _gather(offsets, counts, groups):
+	"""
+		Indexes of the concatenated CSR rows of groups
+
+		@rtype: numpy.ndarray
+	"""
+	lengths = counts[groups]
+	starts = offsets[groups]
+	total = int(lengths.sum())
+	return repeat(starts - (cumsum(lengths) - lengths), lengths) + arange(total)
+
+
+class TaxonomyTree(object):
+	"""Taxonomy tree in arrays with pre-order positions, subtree ranges and CSR child lists"""
+
+	def __init__(self, parents, ranks, rank_names, root=1):
+		"""
+			Build the tree from taxid-indexed arrays, nodes which are not connected to the root are left out
+
+			@param parents: parent taxid of each taxid, negative for unused taxids, the root is its own parent
+			@type parents: numpy.ndarray
+			@param ranks: rank code of each taxid
+			@type ranks: numpy.ndarray
+			@param rank_names: rank of each rank code
+			@type rank_names: list[str]
+			@param root: taxid of the root node
+			@type root: int
+		"""
+		size = len(parents)
+		taxids = flatnonzero(parents >= 0)
+		taxids = taxids[taxids != root]
+		parent_taxids = parents[taxids]
+
+		# children of each taxid, ordered by taxid
+		order = lexsort((taxids, parent_taxids))
+		child_taxids = taxids[order]
+		child_counts = bincount(parent_taxids, minlength=size)
+		child_offsets = concatenate((zeros(1, dtype=int64), cumsum(child_counts)))
+
+		# breadth-first levels, each level is grouped by parent in the order of the level above
+		levels = [arange(root, root + 1)]
+		while True:
+			level = child_taxids[_gather(child_offsets, child_counts, levels[-1])]
+			if not len(level):
+				break
+			levels.append(level)
+
+		subtree_sizes = ones(size, dtype=int64)
+		for level in reversed(levels[1:]):
+			subtree_sizes += bincount(parents[level], weights=subtree_sizes[level], minlength=size).astype(int64)
+
+		# pre-order position: parent position + 1 + sizes of the previous siblings
+		positions = zeros(size, dtype=int64)
+		positions.fill(-1)
+		positions[root] = 0
+		for upper, level in zip(levels, levels[1:]):
+			level_sizes = subtree_sizes[level]
+			preceding = cumsum(level_sizes) - level_sizes
+			lengths = child_counts[upper]
+			first_sibling = repeat(cumsum(lengths) - lengths, lengths)
+			positions[level] = positions[parents[level]] + 1 + preceding - preceding[first_sibling]
+
+		nodes = concatenate(levels)
+		count = len(nodes)
+		self.taxids = zeros(count, dtype=int32)
+		self.taxids[positions[nodes]] = nodes
+		self.positions = positions
+		self.ends = (arange(count) + subtree_sizes[self.taxids]).astype(int32)
+		self.parents = positions[parents[self.taxids]].astype(int32)
+		self.parents[0] = 0
+		self.depths = zeros(count, dtype=int32)
+		for depth, level in enumerate(levels):
+			self.depths[positions[level]] = depth
+		self.ranks = ranks[self.taxids]
+		self.rank_names = rank_names
+		self.active = ones(count, dtype=bool)
+
+		# children by position, in pre-order
+		self.child_counts = bincount(self.parents[1:], minlength=count)
+		self.child_offsets = concatenate((zeros(1, dtype=int64), cumsum(self.child_counts)))
+		self.children = arange(1, count, dtype=int32)[lexsort((arange(1, count), self.parents[1:]))]
+
+	def __len__(self):
+		return len(self.taxids)
+
+	def position(self, taxid):
+		"""
+			Position of a taxid
+
+			@type taxid: int
+
+			@raise KeyError: if the taxid is not in the tree
+			@rtype: int
+		"""
+		if not 0 <= taxid < len(self.positions) or self.positions[taxid] < 0:
+			raise KeyError(taxid)
+		return int(self.positions[taxid])
+
+	def children_of(self, position):
+		"""
+			Positions of the children of a node
+
+			@rtype: numpy.ndarray
+		"""
+		return self.children[self.child_offsets[position]:self.child_offsets[position + 1]]
+
+	def descendants(self, position):
+		"""
+			Positions of all descendants of a node (without the node)
+
+			@rtype: numpy.ndarray
+		"""
+		return arange(position + 1, self.ends[position])
+
+	def is_descendant(self, positions, ancestor):
+		"""
+			Test if nodes are in the subtree of a node (including the node itself)
+
+			@param positions: position or array of positions
+			@param ancestor: position of the subtree root
+
+			@rtype: bool | numpy.ndarray
+		"""
+		return (ancestor <= positions) & (positions < self.ends[ancestor])
+
+	def leaves(self, position):
+		"""
+			Positions of the nodes without children in the subtree of a node
+
+			@rtype: numpy.ndarray
+		"""
+		end = self.ends[position]
+		return position + flatnonzero(self.child_counts[position:end] == 0)
+
+	def lineage(self, position):
+		"""
+			Positions from the root to a node
+
+			@rtype: list[int]
+		"""
+		lineage = [position]
+		while position != 0:
+			position = int(self.parents[position])
+			lineage.append(position)
+		lineage.reverse()
+		return lineage
+
+	def inactivate(self, position):
+		"""
+			Inactivate the subtree of a node and all ancestors which have no active children left
+
+			@return: position of the top inactivated node
+			@rtype: int
+		"""
+		self.active[position:self.ends[position]] = False
+		return self.inactivate_parents(position)
+
+	def inactivate_parents(self, position):
+		"""
+			Inactivate the ancestors of a node which have no active children left
+
+			@return: position of the top inactivated node, or the node itself
+			@rtype: int
+		"""
+		while position != 0:
+			parent = int(self.parents[position])
+			if self.active[self.children_of(parent)].any():
+				break
+			self.active[parent] = False
+			position = parent
+		return position
+
+	def activate(self, position):
+		"""
+			Activate the subtree of a node
+
+			@rtype: None
+		"""
+		self.active[position:self.ends[position]] = True
@@ -12,8 +12,33 @@ class TaxonomyNcbi():
         Represents an interface to the sqlite3 database in which the NCBI taxonomy is stored.
         (NOTE that methods and variables starting with "_" are local and shouldn`t be used from the outside)
 
+        Lineages are read with one recursive query, lists of ncbids with one query joining a temporary table.
+        The queries are constant strings, so sqlite3 reuses their prepared statements. Databases built by
+        ncbitax2sqlite -closure have the lineages stored, lineages and parents at a rank are then read by key.
+
         @author: Ivan
     """
+    # the taxon and its ancestors up to the root, nearest first
+    _LINEAGE_QUERY = str('WITH RECURSIVE lineage(depth, ncbi_taxon_id, parent_taxon_id, node_rank) AS (' +
+                         'SELECT 0, T.ncbi_taxon_id, T.parent_taxon_id, T.node_rank FROM taxon T WHERE T.ncbi_taxon_id=? ' +
+                         'UNION ALL ' +
+                         'SELECT L.depth + 1, T.ncbi_taxon_id, T.parent_taxon_id, T.node_rank FROM taxon T, lineage L ' +
+                         'WHERE T.ncbi_taxon_id=L.parent_taxon_id AND L.ncbi_taxon_id!=1) ' +
+                         'SELECT ncbi_taxon_id, node_rank FROM lineage ORDER BY depth')
+    # the taxa of the temporary table query_taxon and all their ancestors, each once
+    _ANCESTORS_QUERY = str('WITH RECURSIVE ancestor(ncbi_taxon_id) AS (' +
+                           'SELECT Q.ncbi_taxon_id FROM temp.query_taxon Q ' +
+                           'UNION ' +
+                           'SELECT T.parent_taxon_id FROM taxon T, ancestor A WHERE T.ncbi_taxon_id=A.ncbi_taxon_id) ' +
+                           'SELECT T.ncbi_taxon_id, T.parent_taxon_id, T.node_rank FROM taxon T, ancestor A ' +
+                           'WHERE T.ncbi_taxon_id=A.ncbi_taxon_id')
+    # the same from the closure table taxon_ancestor
+    _STORED_LINEAGE_QUERY = str('SELECT A.ancestor_taxon_id, A.ancestor_rank FROM taxon_ancestor A ' +
+                                'WHERE A.ncbi_taxon_id=? ORDER BY A.depth')
+    _STORED_LINEAGES_QUERY = str('SELECT A.ncbi_taxon_id, A.ancestor_taxon_id, A.ancestor_rank ' +
+                                 'FROM temp.query_taxon Q, taxon_ancestor A ' +
+                                 'WHERE A.ncbi_taxon_id=Q.ncbi_taxon_id ORDER BY A.ncbi_taxon_id, A.depth')
+
     def __init__(self, databaseFile, allowedRanks=TAXONOMIC_RANKS, considerNoRank=False):
         """
             @param databaseFile: usually file named "ncbitax_sqlite.db"
@@ -29,6 +54,14 @@ class TaxonomyNcbi():
         except Exception:
             sys.stderr.write(str('TaxonomyNcbi: Failed to create connection to database: ' + databaseFile))
             raise
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        self._tables = set(str(name) for name, in self.cursor.fetchall())
+        # ranks of the columns of taxon_lineage
+        self._lineageRanks = set()
+        if 'taxon_lineage' in self._tables:
+            self.cursor.execute('PRAGMA table_info(taxon_lineage)')
+            self._lineageRanks = set(str(column[1]) for column in self.cursor.fetchall())
+            self._lineageRanks.discard('ncbi_taxon_id')
 
     def getScientificName(self, ncbid, checkRank=False):
         """
@@ -94,6 +127,23 @@ class TaxonomyNcbi():
                 sys.stderr.write(str('TaxonomyNcbi: scientific name "' + name + '" is ambiguous!\n'))
             return None
 
+    def searchNcbids(self, query, limit=20):
+        """
+            Full text search of all names, needs a database built by ncbitax2sqlite -fts
+
+            @param query: FTS5 query, e.g. 'escherichia coli' or 'lactobac*'
+            @param limit: maximum number of results
+            @return: ncbids and names of the best matching names, or None if the database has no search table
+            @rtype: list[(int, str)]
+        """
+        if 'taxon_name_search' not in self._tables:
+            sys.stderr.write('TaxonomyNcbi: The database has no name search table, build it with ncbitax2sqlite -fts\n')
+            return None
+        self.cursor.execute(str('SELECT T.ncbi_taxon_id, S.name FROM taxon_name_search S, taxon T ' +
+                                'WHERE taxon_name_search MATCH ? AND T.taxon_id=S.taxon_id ORDER BY S.rank LIMIT ?'),
+                            (query, limit))
+        return [(int(ncbid), name) for ncbid, name in self.cursor.fetchall()]
+
     def getChildrenNcbids(self, ncbid):  # SELECT T1.ncbi_taxon_id from taxon T1 where T1.parent_taxon_id=818;
         self.cursor.execute(str('SELECT T1.ncbi_taxon_id from taxon T1 where T1.parent_taxon_id=?'),(ncbid,))
         result = self.cursor.fetchall()
@@ -112,32 +162,79 @@ class TaxonomyNcbi():
         """
         if ncbid == 1:
             return None
-        taxonId = self._getTaxonId(ncbid)
-
-        while True:
-            if ncbid == 1 or ncbid == None or taxonId == None: #the root of the taxonomy reached
-                return None
-            ncbid = self._getParentNcbid(taxonId)
-
-            taxonId = self._getTaxonId(ncbid)
-            rank = self._getRank(taxonId)
-            if (rank in self._allowedRanks) or (ncbid == 1 and 'root' in self._allowedRanks):
-                return ncbid
+        parents = self._getAllowedParents(ncbid, self.getLineage(ncbid))
+        if len(parents) == 0:
+            return None
+        return parents[0][0]
 
     def getParentsNcbidSet(self, ncbid):
         """
             @return: set of parent ncbi taxon ids.
             @rtype: set
         """
-        s = set()
-        currentId = ncbid
-        while True:
-            currentId = self.getParentNcbid(currentId)
-            if currentId is None:
-                break
-            else:
-                s.add(currentId)
-        return s
+        return set(parent for parent, rank in self._getAllowedParents(ncbid, self.getLineage(ncbid)))
+
+    def getParentsNcbidSets(self, ncbids):
+        """
+            Batch variant of getParentsNcbidSet
+
+            @param ncbids: ncbi taxon ids
+            @type ncbids: list[int]
+            @return: set of parent ncbi taxon ids of each ncbid
+            @rtype: dict[int, set]
+        """
+        lineages = self.getLineages(ncbids)
+        return dict((ncbid, set(parent for parent, rank in self._getAllowedParents(ncbid, lineages[ncbid])))
+                    for ncbid in lineages)
+
+    def getLineage(self, ncbid):
+        """
+            @return: ncbids and ranks from the taxon up to the root or None if the ncbid is not in the database
+            @rtype: list[(int, str)]
+        """
+        if ncbid == -1:
+            ncbid = 1
+        if 'taxon_ancestor' in self._tables:
+            self.cursor.execute(self._STORED_LINEAGE_QUERY, (ncbid,))
+        else:
+            self.cursor.execute(self._LINEAGE_QUERY, (ncbid,))
+        result = self.cursor.fetchall()
+        if len(result) == 0:
+            return None
+        return [(int(taxon), str(rank)) for taxon, rank in result]
+
+    def getLineages(self, ncbids):
+        """
+            Batch variant of getLineage
+
+            @param ncbids: ncbi taxon ids
+            @type ncbids: list[int]
+            @return: ncbids and ranks from the taxon up to the root (or None) of each ncbid
+            @rtype: dict[int, list[(int, str)]]
+        """
+        if 'taxon_ancestor' in self._tables:
+            return self._getStoredLineages(ncbids)
+        nodes = self._getAncestorNodes(set(1 if ncbid == -1 else ncbid for ncbid in ncbids))
+        # lineage of each visited taxon, the lineages of siblings share the one of their parent
+        known = {}
+        lineages = {}
+        for ncbid in ncbids:
+            taxon = 1 if ncbid == -1 else ncbid
+            if taxon not in nodes:
+                lineages[ncbid] = None
+                continue
+            path = []
+            while taxon in nodes and taxon not in known:
+                path.append(taxon)
+                if taxon == 1:
+                    break
+                taxon = nodes[taxon][0]
+            lineage = known.get(taxon, [])
+            for taxon in reversed(path):
+                lineage = [(taxon, nodes[taxon][1])] + lineage
+                known[taxon] = lineage
+            lineages[ncbid] = list(lineage)
+        return lineages
 
     def getRank(self, ncbid, checkRank=False):
         """
@@ -181,18 +278,31 @@ class TaxonomyNcbi():
            @rtype: int
            @author: jessika
         """
-        myRank = self.getRank(ncbid)
-        if myRank == rank:
-            return ncbid
-        if rank is 'root':
-            return 1
+        if rank in self._lineageRanks:
+            self.cursor.execute('SELECT L."%s" FROM taxon_lineage L WHERE L.ncbi_taxon_id=?' % rank,
+                                (1 if ncbid == -1 else ncbid,))
+            result = self.cursor.fetchall()
+            return self._getStoredParentAtRank(ncbid, rank, result[0][0] if len(result) == 1 else None)
+        return self._getParentAtRank(ncbid, rank, self.getLineage(ncbid))
+
+    def parentsAtRank(self, ncbids, rank):
+        """
+            Batch variant of parentAtRank
 
-        parentSet = self.getParentsNcbidSet(ncbid)
-        for p in parentSet:
-            rankOfParent = self.getRank(p)
-            if rankOfParent == rank:
-                return p
-        return None
+            @param ncbids: ncbi taxon ids
+            @type ncbids: list[int]
+            @return: taxon ID of parent at rank or None of each ncbid
+            @rtype: dict[int, int]
+        """
+        if rank in self._lineageRanks:
+            self._setQueryTaxa(set(1 if ncbid == -1 else ncbid for ncbid in ncbids))
+            self.cursor.execute('SELECT L.ncbi_taxon_id, L."%s" FROM temp.query_taxon Q, taxon_lineage L ' % rank +
+                                'WHERE L.ncbi_taxon_id=Q.ncbi_taxon_id')
+            parents = dict(self.cursor.fetchall())
+            return dict((ncbid, self._getStoredParentAtRank(ncbid, rank, parents.get(1 if ncbid == -1 else ncbid)))
+                        for ncbid in ncbids)
+        lineages = self.getLineages(ncbids)
+        return dict((ncbid, self._getParentAtRank(ncbid, rank, lineages[ncbid])) for ncbid in lineages)
 
     def close(self):
         """
@@ -201,6 +311,74 @@ class TaxonomyNcbi():
         self.cursor.close()
         self.conn.close()
 
+    def _getAllowedParents(self, ncbid, lineage):
+        """
+            @return: ancestors of allowed ranks in the lineage of ncbid, nearest first, and the root if 'root' is allowed
+            @rtype: list[(int, str)]
+        """
+        if lineage is None:
+            return []
+        # the parent of the root (-1) is the root itself
+        if ncbid != -1:
+            lineage = lineage[1:]
+        return [(taxon, rank) for taxon, rank in lineage
+                if (rank in self._allowedRanks) or (taxon == 1 and 'root' in self._allowedRanks)]
+
+    def _getParentAtRank(self, ncbid, rank, lineage):
+        if lineage is not None and lineage[0][1] == rank:
+            return ncbid
+        if rank == 'root':
+            return 1
+        for parent, rankOfParent in self._getAllowedParents(ncbid, lineage):
+            if rankOfParent == rank:
+                return parent
+        return None
+
+    def _getStoredParentAtRank(self, ncbid, rank, parent):
+        """
+            _getParentAtRank for the taxon or nearest ancestor at the rank, as stored in taxon_lineage
+        """
+        if parent is None:
+            return None
+        if parent == ncbid:
+            return ncbid
+        if rank in self._allowedRanks:
+            return int(parent)
+        return None
+
+    def _getStoredLineages(self, ncbids):
+        """
+            getLineages from the closure table taxon_ancestor
+        """
+        self._setQueryTaxa(set(1 if ncbid == -1 else ncbid for ncbid in ncbids))
+        self.cursor.execute(self._STORED_LINEAGES_QUERY)
+        stored = {}
+        for taxon, ancestor, rank in self.cursor.fetchall():
+            stored.setdefault(taxon, []).append((int(ancestor), str(rank)))
+        lineages = {}
+        for ncbid in ncbids:
+            taxon = 1 if ncbid == -1 else ncbid
+            lineages[ncbid] = list(stored[taxon]) if taxon in stored else None
+        return lineages
+
+    def _setQueryTaxa(self, ncbids):
+        """
+            Fill the temporary table query_taxon, which the batch queries join
+        """
+        self.cursor.execute('CREATE TEMP TABLE IF NOT EXISTS query_taxon(ncbi_taxon_id INTEGER PRIMARY KEY)')
+        self.cursor.execute('DELETE FROM temp.query_taxon')
+        self.cursor.executemany('INSERT OR IGNORE INTO temp.query_taxon VALUES(?)', ((ncbid,) for ncbid in ncbids))
+        self.conn.commit()
+
+    def _getAncestorNodes(self, ncbids):
+        """
+            @return: parent ncbid and rank of the taxa and all their ancestors
+            @rtype: dict[int, (int, str)]
+        """
+        self._setQueryTaxa(ncbids)
+        self.cursor.execute(self._ANCESTORS_QUERY)
+        return dict((int(taxon), (int(parent), str(rank))) for taxon, parent, rank in self.cursor.fetchall())
+
     def _getTaxonId(self, ncbid):
         if ncbid is None:
             return None